@@ -0,0 +1,169 @@
+""" throughput benchmarks of the data loading pipeline """
+
+import fire
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from dataset import hierarchical_dataset, leaf_datasets, AlignCollate, LmdbDataset, worker_init_fn
+from dataset import MemoryviewIO, open_image, resize_image, resized_width, dataset_aspect_ratios
+from dataset import MixtureBatchSampler, AspectRatioBatchSampler, PAD_WIDTH_MULTIPLE
+from dataset import LmdbReader, block_shuffle_order
+
+
+def make_opt(imgH=32, imgW=100, rgb=False, PAD=False, character='0123456789abcdefghijklmnopqrstuvwxyz',
+             sensitive=False, batch_max_length=25, data_filtering_off=False, workers=4, **kwargs):
+    return argparse.Namespace(imgH=imgH, imgW=imgW, rgb=rgb, PAD=PAD, character=character,
+                              sensitive=sensitive, batch_max_length=batch_max_length,
+                              data_filtering_off=data_filtering_off, workers=workers, **kwargs)
+
+
+def samples_per_sec(data_loader, num_batches):
+    """ iterate num_batches batches after a warm-up batch which includes the worker startup """
+    data_iter = iter(data_loader)
+    next(data_iter)
+    n_samples = 0
+    start_time = time.time()
+    for _ in range(num_batches):
+        try:
+            images, labels = next(data_iter)
+        except StopIteration:
+            break
+        n_samples += len(labels)
+    return n_samples / (time.time() - start_time)
+
+
+def lmdb_read(root, select_data='/', batch_size=128, num_batches=100, workers=4, **kwargs):
+    """
+    Compare a fresh read transaction per sample, which is what LmdbDataset used to do,
+    with the per-worker transaction which is reused and renewed every LMDB_TXN_RENEW_INTERVAL reads.
+    """
+    opt = make_opt(workers=workers, **kwargs)
+    dataset = hierarchical_dataset(root, opt, select_data=select_data.split('-'))
+    _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+    default_interval = next(d for d in leaf_datasets(dataset) if isinstance(d, LmdbDataset)).txn_renew_interval
+
+    for name, interval in [('transaction per sample', 1), ('reused transaction', default_interval)]:
+        for d in leaf_datasets(dataset):
+            if isinstance(d, LmdbDataset):
+                d.txn_renew_interval = interval
+        data_loader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=True, num_workers=workers,
+            collate_fn=_AlignCollate, worker_init_fn=worker_init_fn)
+        print(f'{name}:\t{samples_per_sec(data_loader, num_batches):0.1f} samples/sec')
+
+
+def jpeg_draft(lmdb_path, num_samples=2000, tolerance=2.0, **kwargs):
+    """
+    Decode speed of full JPEG decoding against --jpeg_draft, and how far the resized images of both are apart.
+    tolerance is the largest accepted mean absolute difference of a resized image, in 0-255 pixel values.
+    """
+    opt = make_opt(workers=0, **kwargs)
+    draft_opt = make_opt(workers=0, jpeg_draft=True, **kwargs)
+    dataset = LmdbDataset(lmdb_path, opt)
+    txn = dataset.get_txn()
+    image_list = []
+    for index in dataset.filtered_index_list[:num_samples]:
+        imgbuf = bytes(txn.get('image-%09d'.encode() % index))
+        if imgbuf[:2] == b'\xff\xd8':  # JPEG only, draft does not change other formats
+            image_list.append(imgbuf)
+    print(f'{len(image_list)} JPEGs out of the first {num_samples} samples')
+
+    resized = {}
+    for name, decode_opt in [('full decode', opt), ('draft decode', draft_opt)]:
+        start_time = time.time()
+        images = [open_image(MemoryviewIO(imgbuf), decode_opt) for imgbuf in image_list]
+        elapsed_time = time.time() - start_time
+        print(f'{name}:\t{len(images) / elapsed_time:0.1f} images/sec')
+        resized[name] = [resize_image(image, opt.imgH, opt.imgW, opt.PAD).astype(np.float32)
+                         for image in images]
+
+    diff = np.array([np.abs(full - draft).mean()
+                     for full, draft in zip(resized['full decode'], resized['draft decode'])])
+    print(f'mean abs difference: mean {diff.mean():0.3f}, max {diff.max():0.3f}, '
+          f'{(diff > tolerance).sum()} images above tolerance {tolerance}')
+
+
+def padded_fraction(widths, batches, imgW):
+    """ fraction of padded pixels when each batch is padded up to its widest image """
+    batch_widths = np.array([min(-(-widths[batch].max() // PAD_WIDTH_MULTIPLE) * PAD_WIDTH_MULTIPLE, imgW)
+                             for batch in batches])
+    batch_sizes = np.array([len(batch) for batch in batches])
+    used = sum(widths[batch].sum() for batch in batches)
+    return 1 - used / float((batch_widths * batch_sizes).sum())
+
+
+def pad_fraction(root, select_data='/', batch_size=192, aspect_ratio_pool=32, **kwargs):
+    """
+    Fraction of padded pixels of --PAD batches: padded to imgW, padded to the widest image of random batches
+    (--pad_to_batch_width) and of batches grouped by aspect ratio (--aspect_ratio_pool).
+    """
+    opt = make_opt(PAD=True, **kwargs)
+    dataset = hierarchical_dataset(root, opt, select_data=select_data.split('-'))
+    widths = np.array([resized_width(ratio, 1, opt.imgH, opt.imgW, True)
+                       for ratio in dataset_aspect_ratios(dataset)])
+    print(f'padded to imgW:	{1 - widths.mean() / opt.imgW:0.3f}')
+
+    random_batches = np.array_split(np.random.permutation(len(widths)), max(len(widths) // batch_size, 1))
+    print(f'random batches:	{padded_fraction(widths, random_batches, opt.imgW):0.3f}')
+
+    ratios = dataset_aspect_ratios(dataset)
+    sampler = MixtureBatchSampler([len(dataset)], [batch_size], aspect_ratio_list=ratios,
+                                  bucket_pool=aspect_ratio_pool)
+    print(f'training batches, pool of {aspect_ratio_pool}:	'
+          f'{padded_fraction(widths, [np.array(b) for b in sampler], opt.imgW):0.3f}')
+    sampler = AspectRatioBatchSampler(ratios, batch_size)
+    print(f'evaluation batches:	{padded_fraction(widths, [np.array(b) for b in sampler], opt.imgW):0.3f}')
+
+
+def drop_page_cache(lmdb_path):
+    """ evict data.mdb from the page cache, so that the next reads come from the disk """
+    LmdbReader.close(lmdb_path)
+    fd = os.open(os.path.join(lmdb_path, 'data.mdb'), os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_throughput(dataset, order, batch_size):
+    """ read the raw images in order, each batch in key order as LmdbDataset.__getitems__ does """
+    n_bytes = 0
+    start_time = time.time()
+    for start in range(0, len(order), batch_size):
+        txn = dataset.get_txn(reads=batch_size)
+        for index in np.sort(dataset.filtered_index_list[order[start:start + batch_size]]):
+            n_bytes += len(bytes(txn.get('image-%09d'.encode() % index)))
+    elapsed_time = time.time() - start_time
+    return len(order) / elapsed_time, n_bytes / elapsed_time / 2 ** 20
+
+
+def block_shuffle(lmdb_path, num_samples=20000, batch_size=192, block_size=256, window=32, **kwargs):
+    """
+    Raw image read throughput of one LMDB with a full shuffle, with block_shuffle_order and in key order,
+    each on a cold page cache (dropped with posix_fadvise, needs Linux) and then warm.
+    """
+    opt = make_opt(workers=0, **kwargs)
+    dataset = LmdbDataset(lmdb_path, opt)
+    orders = [
+        ('full shuffle', np.random.permutation(len(dataset))),
+        (f'block shuffle {block_size}x{window}', block_shuffle_order(len(dataset), block_size, window)),
+        ('sequential', np.arange(len(dataset))),
+    ]
+    for name, order in orders:
+        drop_page_cache(lmdb_path)
+        for cache in ('cold', 'warm'):
+            samples_sec, mb_sec = read_throughput(dataset, order[:num_samples], batch_size)
+            print(f'{name}, {cache}:\t{samples_sec:0.1f} samples/sec\t{mb_sec:0.1f} MB/sec')
+
+
+if __name__ == '__main__':
+    fire.Fire({
+        'lmdb_read': lmdb_read,
+        'jpeg_draft': jpeg_draft,
+        'pad_fraction': pad_fraction,
+        'block_shuffle': block_shuffle,
+    })
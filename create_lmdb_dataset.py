@@ -2,10 +2,32 @@
 
 import fire
 import os
+import io
+import json
+import glob
 import lmdb
 import cv2
+import hashlib
+import itertools
+import multiprocessing
 
 import numpy as np
+from PIL import Image
+
+from dataset import extend_sidecars, pack_sample_metadata, LMDB_SHARDS, SAMPLE_METADATA_PREFIX, UNLABELED_DATA
+from create_manifest import update_manifests
+
+# written in the same transaction as every block of samples, so that an interrupted build can be resumed
+PROGRESS_KEY = 'build-progress'.encode()
+# parameters of the preprocessing of the stored images, only present if they were preprocessed
+PREPROCESS_KEY = 'build-preprocess'.encode()
+CODECS = ('png', 'webp', 'jpg')
+# on-disk index of the image hashes of an LMDB, for deduplication. It is a single file next to data.mdb,
+# so that the LMDB directory stays a leaf directory for hierarchical_dataset.
+HASH_INDEX = 'hash_index.lmdb'
+HASH_INDEX_COUNT_KEY = 'num-indexed'.encode()
+# side of the grayscale thumbnail compared by dedupThumbnail
+THUMBNAIL_SIZE = 16
 
 
 def checkImageIsValid(imageBin):
@@ -19,73 +41,434 @@ def checkImageIsValid(imageBin):
     return True
 
 
-def writeCache(env, cache):
-    with env.begin(write=True) as txn:
-        for k, v in cache.items():
-            txn.put(k, v)
+def writeCache(env, cache, append=False):
+    """
+    write cache in one transaction, the map size of env is doubled until it fits.
+    With append, the keys of cache are sorted and larger than the ones in env, which fills the pages completely.
+    """
+    while True:
+        try:
+            with env.begin(write=True) as txn:
+                for k, v in cache.items():
+                    txn.put(k, v, append=append)
+            return
+        except lmdb.MapFullError:
+            env.set_mapsize(env.info()['map_size'] * 2)
 
 
-def createDataset(inputPath, gtFile, outputPath, checkValid=True):
+class DatasetWriter(object):
+    """
+    The single writer of the output LMDB or, with shardBytes, of a sequence of LMDB shards holding about
+    shardBytes of samples each, listed in LMDB_SHARDS. Samples are numbered globally from 1 by the caller,
+    each shard numbers its own samples from 1 so that it is a complete LMDB by itself.
+    The build progress is kept in the last shard.
+    """
+
+    def __init__(self, outputPath, mapSize, shardBytes=None, preprocess=None):
+        self.outputPath = outputPath
+        self.mapSize = mapSize
+        self.shardBytes = shardBytes
+        self.preprocess = preprocess
+        os.makedirs(outputPath, exist_ok=True)
+        sharded = os.path.exists(os.path.join(outputPath, LMDB_SHARDS))
+        if shardBytes is None and sharded:
+            raise ValueError(f'{outputPath} holds a sharded dataset, give --shardBytes')
+        if shardBytes is not None and os.path.exists(os.path.join(outputPath, 'data.mdb')):
+            raise ValueError(f'{outputPath} holds a dataset which is not sharded')
+
+        if shardBytes is None:
+            self.shards = [outputPath]
+        else:
+            self.shards = sorted(glob.glob(os.path.join(outputPath, 'shard-*'))) or [self.shard_path(0)]
+        self.shard_sizes = [int(self.read_key(shard, 'num-samples'.encode())) for shard in self.shards[:-1]]
+        self.env = lmdb.open(self.shards[-1], map_size=mapSize)
+        self.shard_sizes.append(int(self.get('num-samples'.encode()) or 0))
+        stat = self.env.stat()
+        self.shard_used = stat['psize'] * (stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages'])
+        self.cache = {}
+        # metadata rows of the added samples, from local index metadata_start on
+        self.metadata = []
+        self.metadata_start = None
+
+    def shard_path(self, i):
+        return os.path.join(self.outputPath, 'shard-%05d' % i)
+
+    @staticmethod
+    def read_key(path, key):
+        env = lmdb.open(path, readonly=True, lock=False)
+        with env.begin() as txn:
+            value = txn.get(key)
+        env.close()
+        return value
+
+    @property
+    def num_samples(self):
+        return sum(self.shard_sizes)
+
+    def get(self, key):
+        """ a value of the current shard """
+        with self.env.begin() as txn:
+            return txn.get(key)
+
+    def committed(self, key):
+        """ a value of the current shard, of the previous one if the build stopped before committing to a new one """
+        value = self.get(key)
+        if value is None and len(self.shards) > 1:
+            value = self.read_key(self.shards[-2], key)
+        return value
+
+    def progress(self):
+        """ the build progress """
+        return self.committed(PROGRESS_KEY)
+
+    def add(self, imageBin, label, progress, metadata):
+        """
+        add the next sample with its metadata row (label_length, width, height, unlabeled).
+        progress is committed if the sample starts a new shard.
+        """
+        if self.shardBytes is not None and self.shard_sizes[-1] > 0 and \
+                self.shard_used + len(imageBin) > self.shardBytes:
+            self.commit(progress)
+            self.env.close()
+            self.shards.append(self.shard_path(len(self.shards)))
+            self.env = lmdb.open(self.shards[-1], map_size=self.mapSize)
+            self.shard_sizes.append(0)
+            self.shard_used = 0
+
+        self.shard_sizes[-1] += 1
+        self.cache['image-%09d'.encode() % self.shard_sizes[-1]] = imageBin
+        self.cache['label-%09d'.encode() % self.shard_sizes[-1]] = label
+        if not self.metadata:
+            self.metadata_start = self.shard_sizes[-1]
+        self.metadata.append(metadata)
+        self.shard_used += len(imageBin) + len(label)
+
+    def commit(self, progress):
+        """ write the added samples and their metadata together with num-samples and progress in one transaction """
+        if self.metadata:
+            self.cache[SAMPLE_METADATA_PREFIX + b'%09d' % self.metadata_start] = pack_sample_metadata(self.metadata)
+            self.metadata = []
+        self.cache['num-samples'.encode()] = str(self.shard_sizes[-1]).encode()
+        self.cache[PROGRESS_KEY] = json.dumps(progress).encode()
+        if self.preprocess is not None:
+            self.cache[PREPROCESS_KEY] = json.dumps(self.preprocess, sort_keys=True).encode()
+        writeCache(self.env, self.cache)
+        self.cache = {}
+        if self.shardBytes is not None:
+            shard_list = {
+                'num_samples': self.num_samples,
+                'shards': [{'path': os.path.basename(shard), 'num_samples': size}
+                           for shard, size in zip(self.shards, self.shard_sizes)],
+            }
+            tmp_path = os.path.join(self.outputPath, f'{LMDB_SHARDS}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(shard_list, f, indent=2)
+            os.replace(tmp_path, os.path.join(self.outputPath, LMDB_SHARDS))
+
+    def images(self, start):
+        """ (global index, image) of the samples from global index start on """
+        offset = 0
+        for shard, size in zip(self.shards, self.shard_sizes):
+            if offset + size >= start:
+                env = self.env if shard == self.shards[-1] else lmdb.open(shard, readonly=True, lock=False)
+                with env.begin() as txn:
+                    for index in range(max(start - offset, 1), size + 1):
+                        yield offset + index, txn.get('image-%09d'.encode() % index)
+                if env is not self.env:
+                    env.close()
+            offset += size
+
+    def close(self):
+        self.env.close()
+
+    def extend_sidecars(self, base, workers):
+        """ extend the sidecars of the shards which had some of the first base samples before this build """
+        offset = 0
+        for shard, size in zip(self.shards, self.shard_sizes):
+            if 0 < base - offset < size:
+                extend_sidecars(shard, base - offset, size, workers)
+            offset += size
+
+
+def imageHashes(imageBin, thumbnail=False):
+    """
+    index keys of an image: the hash of its bytes and, with thumbnail, the hash of its size and
+    its grayscale thumbnail quantized to 16 levels, which also matches re-encoded copies.
+    """
+    keys = [b'b' + hashlib.blake2b(imageBin, digest_size=16).digest()]
+    if thumbnail:
+        img = cv2.imdecode(np.frombuffer(imageBin, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is not None:
+            thumb = cv2.resize(img, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA) >> 4
+            keys.append(b't' + hashlib.blake2b(b'%dx%d:' % img.shape + thumb.tobytes(), digest_size=16).digest())
+    return keys
+
+
+def hashSample(args):
+    """ (index, hash keys) of a stored sample, in a worker process """
+    index, imageBin, thumbnail = args
+    return index, imageHashes(imageBin, thumbnail)
+
+
+def openHashIndex(writer, outputPath, thumbnail, pool=None, commitInterval=10000):
+    """
+    open the hash index of the dataset written by writer at outputPath and add the samples which it is
+    missing: all of them if it is new, or the last block if the build was interrupted between the two commits.
+    The missing samples are hashed by pool in blocks of commitInterval, each committed with the indexed count,
+    so that indexing a large dataset stays bounded in memory and can itself be interrupted.
+    """
+    index_env = lmdb.open(os.path.join(outputPath, HASH_INDEX), subdir=False, map_size=writer.mapSize // 16)
+    with index_env.begin() as index_txn:
+        indexed = int(index_txn.get(HASH_INDEX_COUNT_KEY, b'0'))
+    nSamples = writer.num_samples
+    if nSamples > indexed:
+        print('Indexing the hashes of %d samples' % (nSamples - indexed))
+    images = ((index, imageBin, thumbnail) for index, imageBin in writer.images(indexed + 1))
+    while True:
+        block = list(itertools.islice(images, commitInterval))
+        if not block:
+            break
+        results = pool.map(hashSample, block, chunksize=64) if pool is not None else map(hashSample, block)
+        cache = {}
+        with index_env.begin() as index_txn:
+            for index, keys in results:
+                for key in keys:
+                    # the index keeps pointing at the first sample of each hash
+                    if key not in cache and index_txn.get(key) is None:
+                        cache[key] = str(index).encode()
+        cache[HASH_INDEX_COUNT_KEY] = str(block[-1][0]).encode()
+        writeCache(index_env, cache)
+    return index_env
+
+
+def readGtFile(gtFile, inputPath, start=0):
+    """ stream (line number, image path, label) from the gt file, starting at line number start """
+    with open(gtFile, 'r', encoding='utf-8') as data:
+        for i, line in enumerate(itertools.islice(data, start, None), start):
+            line_info = line.strip('\n').split('\t')
+            if len(line_info) < 2:
+                print('line %d has no label' % i)
+                continue
+            imagePath, label = line_info[:2]
+            yield i, os.path.join(inputPath, imagePath), label
+
+
+def imageSize(imageBin):
+    """ (width, height) from the image header, (0, 0) if it can not be read """
+    try:
+        return Image.open(io.BytesIO(imageBin)).size
+    except IOError:
+        return 0, 0
+
+
+def preprocessImage(imageBin, channels, maxHeight, codec, quality):
+    """
+    decode an image to channels (1 or 3), shrink it to at most maxHeight pixels high keeping its aspect ratio
+    and encode it with codec. quality applies to 'jpg' and 'webp', 'webp' is lossless above 100.
+    Returns None if the image can not be decoded.
+    """
+    img = cv2.imdecode(np.frombuffer(imageBin, dtype=np.uint8),
+                       cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR)
+    if img is None or img.size == 0:
+        return None
+    h, w = img.shape[:2]
+    if maxHeight and h > maxHeight:
+        img = cv2.resize(img, (max(1, round(w * maxHeight / h)), maxHeight), interpolation=cv2.INTER_AREA)
+    params = {'jpg': [cv2.IMWRITE_JPEG_QUALITY, quality], 'webp': [cv2.IMWRITE_WEBP_QUALITY, quality]}.get(codec, [])
+    ok, encoded = cv2.imencode('.' + codec, img, params)
+    return encoded.tobytes() if ok else None
+
+
+def readSample(args):
+    """
+    read the image of a gt line and check it, in a worker process. Returns (imageBin, error, hash keys, size),
+    the hash keys are only computed with dedup.
+    """
+    i, imagePath, label, checkValid, dedup, thumbnail, preprocess = args
+
+    # # only use alphanumeric data
+    # if re.search('[^a-zA-Z0-9]', label):
+    #     continue
+
+    if not os.path.exists(imagePath):
+        return None, '%s does not exist' % imagePath, [], None
+    with open(imagePath, 'rb') as f:
+        imageBin = f.read()
+    if checkValid:
+        try:
+            if not checkImageIsValid(imageBin):
+                return None, '%s is not a valid image' % imagePath, [], None
+        except Exception:
+            return None, 'error occured %d' % i, [], None
+    if preprocess is not None:
+        imageBin = preprocessImage(imageBin, **preprocess)
+        if imageBin is None:
+            return None, '%s is not a valid image' % imagePath, [], None
+    return imageBin, None, imageHashes(imageBin, thumbnail) if dedup else [], imageSize(imageBin)
+
+
+def createDataset(inputPath, gtFile, outputPath, checkValid=True, workers=4, commitInterval=10000,
+                  mapSize=1073741824, append=False, dedup=None, dedupThumbnail=False, shardBytes=None,
+                  preprocess=False, channels=1, maxHeight=64, codec='png', quality=95):
     """
     Create LMDB dataset for training and evaluation.
+    The gt file is streamed in blocks of commitInterval lines, whose images are read and checked by
+    a pool of worker processes while the previous block is written. Each block is committed in one
+    transaction together with num-samples and the build progress, so a build which was interrupted
+    continues after its last committed block when it is started again with the same arguments.
+    With append, the samples of gtFile are added after the ones of an existing LMDB. Its filtered index
+    and aspect ratio sidecars and the manifests listing it are then extended by the new samples only.
+    With dedup, images whose bytes (and with dedupThumbnail, whose grayscale thumbnails) equal the ones of
+    an earlier sample are listed in duplicates.txt and skipped ('skip') or written anyway ('report').
+    The hashes are looked up in an on-disk index next to the LMDB, which is kept across resumes and appends.
+    Every block also stores the label length, image size and unlabeled flag of its samples as one
+    metadata value, which lets the filtering and the aspect ratios skip reading labels and image headers.
+    With shardBytes, outputPath holds LMDB shards of about shardBytes each instead of one LMDB,
+    which hierarchical_dataset reads as one dataset.
+    With preprocess, the images are converted to channels, shrunk to maxHeight and re-encoded with codec
+    before they are stored, e.g. 1 channel and a small height for training without --rgb. The parameters
+    are stored under PREPROCESS_KEY, and resuming or appending with other parameters is refused.
     ARGS:
         inputPath  : input folder path where starts imagePath
         outputPath : LMDB output path
         gtFile     : list of image path and label
         checkValid : if true, check the validity of every image
+        workers    : number of processes reading and checking the images (0 reads them in this process)
+        commitInterval : number of gt lines per transaction
+        mapSize    : initial map size of the LMDB in bytes, it is doubled whenever it is full
+        append     : add the samples of gtFile to the existing LMDB at outputPath
+        dedup      : 'skip' or 'report' duplicate images, None does not look for duplicates
+        dedupThumbnail : also compare decoded grayscale thumbnails, not only the image bytes
+        shardBytes : write shards of at most this many bytes of samples (None writes a single LMDB)
+        preprocess : store preprocessed images instead of the original files
+        channels   : with preprocess, 1 (grayscale) or 3 (color)
+        maxHeight  : with preprocess, images higher than this are shrunk to it (0 keeps the size)
+        codec      : with preprocess, 'png' (lossless), 'webp' or 'jpg'
+        quality    : with preprocess, quality of 'jpg' and 'webp' from 0 to 100, 101 is lossless 'webp'
     """
-    os.makedirs(outputPath, exist_ok=True)
-    env = lmdb.open(outputPath, map_size=1099511627776)
-    cache = {}
+    if dedup not in (None, 'skip', 'report'):
+        raise ValueError(f"dedup is 'skip', 'report' or None, not {dedup}")
+    if preprocess:
+        if channels not in (1, 3):
+            raise ValueError(f'channels is 1 or 3, not {channels}')
+        if codec not in CODECS:
+            raise ValueError(f'codec is one of {CODECS}, not {codec}')
+        preprocess = {'channels': channels, 'maxHeight': maxHeight, 'codec': codec, 'quality': quality}
+    else:
+        preprocess = None
+    writer = DatasetWriter(outputPath, mapSize, shardBytes, preprocess)
     cnt = 1
+    start = 0
+    # number of samples before this build, which are kept
+    base = 0
 
-    with open(gtFile, 'r', encoding='utf-8') as data:
-        datalist = data.readlines()
-
-    nSamples = len(datalist)
-    for i in range(nSamples):
-        line_info = datalist[i].strip('\n').split('\t')
-        if len(line_info) == 2:
-            imagePath, label = line_info
-        elif len(line_info) > 2:
-            imagePath, label = line_info[:2]
-        imagePath = os.path.join(inputPath, imagePath)
-
-        # # only use alphanumeric data
-        # if re.search('[^a-zA-Z0-9]', label):
-        #     continue
-
-        if not os.path.exists(imagePath):
-            print('%s does not exist' % imagePath)
-            continue
-        with open(imagePath, 'rb') as f:
-            imageBin = f.read()
-        if checkValid:
-            try:
-                if not checkImageIsValid(imageBin):
-                    print('%s is not a valid image' % imagePath)
-                    continue
-            except:
-                print('error occured', i)
-                with open(outputPath + '/error_image_log.txt', 'a') as log:
-                    log.write('%s-th image data occured error\n' % str(i))
+    gt_id = os.path.abspath(gtFile)
+    progress = writer.progress()
+    num_samples = writer.num_samples
+    # a finished build may hold 0 samples, it still has num-samples
+    has_dataset = writer.committed('num-samples'.encode()) is not None
+    if progress is not None:
+        progress = json.loads(progress.decode())
+    if progress is not None and not progress['done']:
+        # an interrupted build or append, which can only be continued
+        if progress['gtFile'] != gt_id:
+            raise ValueError(f"{outputPath} is being built from {progress['gtFile']}, not from {gt_id}")
+        start = progress['lines']
+        base = progress.get('base', 0)
+        cnt = num_samples + 1
+        print('Resuming after %d lines, %d samples' % (start, cnt - 1))
+    elif append:
+        if not has_dataset:
+            raise ValueError(f'{outputPath} holds no dataset to append to')
+        base = num_samples
+        cnt = base + 1
+        print('Appending to %d samples' % base)
+    elif progress is not None and progress['gtFile'] == gt_id:
+        print('%s is already complete with %d samples' % (outputPath, num_samples))
+        writer.close()
+        return
+    elif has_dataset:
+        raise ValueError(f'{outputPath} already holds a dataset, use --append to add samples to it')
+    if has_dataset:
+        stored = writer.committed(PREPROCESS_KEY)
+        if (json.loads(stored.decode()) if stored is not None else None) != preprocess:
+            raise ValueError(f'{outputPath} holds images preprocessed with {stored and stored.decode()}, '
+                             f'not with {preprocess}')
+
+    pool = multiprocessing.Pool(workers) if workers > 0 else None
+    index_env = openHashIndex(writer, outputPath, dedupThumbnail, pool, commitInterval) if dedup else None
+    num_duplicates = 0
+
+    lines = readGtFile(gtFile, inputPath, start)
+
+    def read_block():
+        block = [(i, imagePath, label, checkValid, dedup, dedupThumbnail, preprocess)
+                 for i, imagePath, label in itertools.islice(lines, commitInterval)]
+        if pool is None:
+            return block, list(map(readSample, block))
+        return block, pool.map_async(readSample, block, chunksize=64)
+
+    pending = read_block()
+    while pending[0]:
+        block, results = pending
+        # the next block is read by the pool while this one is written
+        pending = read_block()
+        if pool is not None:
+            results = results.get()
+
+        hash_cache = {}
+        index_txn = index_env.begin() if index_env is not None else None
+        for (i, imagePath, label, *_), (imageBin, error, hash_keys, size) in zip(block, results):
+            if error is not None:
+                print(error)
+                if error.startswith('error occured'):
+                    with open(outputPath + '/error_image_log.txt', 'a') as log:
+                        log.write('%s-th image data occured error\n' % str(i))
                 continue
 
-        imageKey = 'image-%09d'.encode() % cnt
-        labelKey = 'label-%09d'.encode() % cnt
-        cache[imageKey] = imageBin
-        cache[labelKey] = label.encode()
+            duplicates = [(key, hash_cache.get(key) or index_txn.get(key)) for key in hash_keys]
+            duplicates = [(key, index) for key, index in duplicates if index is not None]
+            if duplicates:
+                num_duplicates += 1
+                key, index = duplicates[0]
+                with open(outputPath + '/duplicates.txt', 'a') as log:
+                    log.write('%d\t%s\t%s\t%s\n' % (i, imagePath, index.decode(),
+                                                    'bytes' if key[:1] == b'b' else 'thumbnail'))
+                if dedup == 'skip':
+                    continue
+            # the index keeps pointing at the first sample of each hash
+            for key in set(hash_keys) - {key for key, _ in duplicates}:
+                hash_cache[key] = str(cnt).encode()
 
-        if cnt % 1000 == 0:
-            writeCache(env, cache)
-            cache = {}
-            print('Written %d / %d' % (cnt, nSamples))
-        cnt += 1
+            metadata = (min(len(label), 0xffff), *(min(side, 0xffff) for side in size), label == UNLABELED_DATA)
+            writer.add(imageBin, label.encode(), {'gtFile': gt_id, 'lines': i, 'base': base, 'done': False},
+                       metadata)
+            cnt += 1
+
+        start = block[-1][0] + 1
+        writer.commit({'gtFile': gt_id, 'lines': start, 'base': base, 'done': False})
+        if index_env is not None:
+            # the index is committed after the samples, openHashIndex catches up if it falls behind.
+            index_txn.abort()
+            hash_cache[HASH_INDEX_COUNT_KEY] = str(cnt - 1).encode()
+            writeCache(index_env, hash_cache)
+        print('Written %d samples of %d lines' % (cnt - 1, start))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     nSamples = cnt-1
-    cache['num-samples'.encode()] = str(nSamples).encode()
-    writeCache(env, cache)
+    writer.commit({'gtFile': gt_id, 'lines': start, 'base': base, 'done': True})
+    writer.close()
+    if index_env is not None:
+        index_env.close()
+        print('%d duplicate images %s' % (num_duplicates, 'skipped' if dedup == 'skip' else 'reported'))
     print('Created dataset with %d samples' % nSamples)
 
+    if 0 < base < nSamples:
+        writer.extend_sidecars(base, workers)
+        update_manifests(outputPath, workers)
+
 
 if __name__ == '__main__':
     fire.Fire(createDataset)
@@ -0,0 +1,133 @@
+""" write the manifest of a dataset root, which hierarchical_dataset reads instead of walking the tree """
+
+import fire
+import os
+import glob
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+from dataset import LmdbDataset, LmdbReader, MANIFEST, SHARD_META, SHARD_LABELS, LMDB_SHARDS
+from dataset import dataset_dirs, dataset_stat, load_manifest, lmdb_content_blocks, lmdb_content_hash
+
+
+def filtered_counts(dirpath):
+    """ number of samples in each filtered index sidecar of the LMDB at dirpath """
+    counts = {}
+    for cache_path in sorted(glob.glob(os.path.join(dirpath, 'filtered_index_*.npz'))):
+        with np.load(cache_path) as cache:
+            counts[os.path.basename(cache_path)] = len(cache['index'])
+    return counts
+
+
+def lmdb_entry(dirpath, opt=None, workers=0, previous=None):
+    """ sample count, content hash and filtered counts of the LMDB at dirpath, see manifest_entry """
+    nSamples = int(bytes(LmdbReader.get(dirpath).txn.get('num-samples'.encode())))
+    if opt is not None:
+        LmdbDataset(dirpath, opt, num_samples=nSamples)
+    if previous is not None and 'content_blocks' in previous:
+        content_blocks = lmdb_content_blocks(dirpath, nSamples, workers, previous['content_blocks'],
+                                             previous['num_samples'])
+    else:
+        content_blocks = lmdb_content_blocks(dirpath, nSamples, workers)
+    LmdbReader.close(dirpath)
+    return {
+        'num_samples': nSamples,
+        'content_hash': lmdb_content_hash(nSamples, content_blocks),
+        'content_blocks': content_blocks,
+        'filtered': filtered_counts(dirpath),
+    }
+
+
+def manifest_entry(root, dirpath, opt=None, workers=0, previous=None):
+    """
+    The manifest entry of the dataset in the directory dirpath. With opt, the filtered index
+    for its filtering options is built first, so that its count is recorded as well.
+    previous is the entry of the same LMDB before samples were appended to it, whose content hash
+    blocks are reused.
+    """
+    entry = {'path': os.path.relpath(dirpath, root)}
+    if os.path.exists(os.path.join(dirpath, SHARD_META)):
+        with open(os.path.join(dirpath, SHARD_META)) as f:
+            meta = json.load(f)
+        with open(os.path.join(dirpath, SHARD_LABELS), 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        entry.update(format='shard', num_samples=meta['num_samples'], content_hash=content_hash, filtered={})
+    elif os.path.exists(os.path.join(dirpath, LMDB_SHARDS)):
+        with open(os.path.join(dirpath, LMDB_SHARDS)) as f:
+            shard_list = json.load(f)
+        previous_shards = {shard['path']: shard for shard in (previous or {}).get('shards', [])}
+        shards = [dict(path=shard['path'], **lmdb_entry(os.path.join(dirpath, shard['path']), opt, workers,
+                                                         previous_shards.get(shard['path'])))
+                  for shard in shard_list['shards']]
+        content_hash = hashlib.sha1(''.join(shard['content_hash'] for shard in shards).encode()).hexdigest()
+        entry.update(format='sharded_lmdb', num_samples=sum(shard['num_samples'] for shard in shards),
+                     content_hash=content_hash, shards=shards,
+                     filtered={os.path.join(shard['path'], name): count
+                               for shard in shards for name, count in shard['filtered'].items()})
+    else:
+        entry.update(format='lmdb', **lmdb_entry(dirpath, opt, workers, previous))
+    entry['stat'] = dataset_stat(dirpath, entry['format'])
+    return entry
+
+
+def write_manifest(root, manifest):
+    """ replace the manifest at root at once, so that a training job never reads a partial one """
+    manifest_path = os.path.join(root, MANIFEST)
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def update_manifests(dirpath, workers=0):
+    """
+    Update the entry of the LMDB at dirpath in the manifests of the dataset roots above it,
+    after samples were appended to it.
+    """
+    dirpath = os.path.abspath(dirpath)
+    root = dirpath
+    while True:
+        manifest = load_manifest(root)
+        if manifest is not None:
+            for i, entry in enumerate(manifest['datasets']):
+                if os.path.normpath(os.path.join(root, entry['path'])) == dirpath:
+                    manifest['datasets'][i] = manifest_entry(root, dirpath, workers=workers, previous=entry)
+                    write_manifest(root, manifest)
+                    print(f'updated {os.path.join(root, MANIFEST)}')
+        parent = os.path.dirname(root)
+        if parent == root:
+            return
+        root = parent
+
+
+def createManifest(root, character='0123456789abcdefghijklmnopqrstuvwxyz', sensitive=False,
+                   batch_max_length=25, filtering=True, workers=4):
+    """
+    Write the manifest of all LMDB and shard datasets under root. It lists every sub-dataset in the
+    order hierarchical_dataset used to find them, with its sample count, filtered counts and content hash.
+    Run it again after a dataset under root was added or changed.
+    ARGS:
+        root       : dataset root, e.g. the --src_train_data or --eval_data of a training run
+        character, sensitive, batch_max_length : filtering options whose filtered indices are built and counted
+        filtering  : build the filtered indices for these options (False only records existing ones)
+        workers    : number of processes scanning each LMDB
+    """
+    opt = argparse.Namespace(character=character, sensitive=sensitive, batch_max_length=batch_max_length,
+                             data_filtering_off=False, workers=workers) if filtering else None
+    datasets = []
+    for dirpath in dataset_dirs(root):
+        if not any(os.path.exists(os.path.join(dirpath, name)) for name in (SHARD_META, LMDB_SHARDS, 'data.mdb')):
+            continue
+        entry = manifest_entry(root, dirpath, opt, workers)
+        print(f"{entry['path']}\t{entry['format']}\tnum samples: {entry['num_samples']}")
+        datasets.append(entry)
+
+    write_manifest(root, {'datasets': datasets})
+    print('Created manifest of %d datasets' % len(datasets))
+
+
+if __name__ == '__main__':
+    fire.Fire(createManifest)
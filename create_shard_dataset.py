@@ -0,0 +1,85 @@
+""" convert LMDB datasets into pre-decoded shards which ShardDataset memory-maps at training time """
+
+import fire
+import os
+import json
+import argparse
+import functools
+
+import numpy as np
+import torch
+
+from dataset import LmdbDataset, SHARD_META, SHARD_IMAGES, SHARD_LABELS, resize_image
+
+
+def resize_batch(batch, imgH, imgW, keep_ratio_with_pad):
+    images, labels = zip(*batch)
+    aspect_ratios = np.array([image.size[0] / float(image.size[1]) for image in images], dtype=np.float32)
+    images = np.stack([resize_image(image, imgH, imgW, keep_ratio_with_pad) for image in images])
+    return images, labels, aspect_ratios
+
+
+def createShardDataset(lmdbPath, outputPath, imgH=32, imgW=100, rgb=False, PAD=False,
+                       character='0123456789abcdefghijklmnopqrstuvwxyz', sensitive=False,
+                       batch_max_length=25, data_filtering_off=False, workers=4):
+    """
+    Create a pre-decoded shard from an LMDB dataset. The shard is only valid for the
+    training options given here, ShardDataset refuses to load it with other ones.
+    ARGS:
+        lmdbPath   : LMDB dataset created by create_lmdb_dataset.py
+        outputPath : shard output path
+        imgH, imgW, rgb, PAD : image options of the training run
+        character, sensitive, batch_max_length, data_filtering_off : label options of the training run
+        workers    : number of processes decoding the images
+    """
+    opt = argparse.Namespace(imgH=imgH, imgW=imgW, rgb=rgb, PAD=PAD, character=character,
+                             sensitive=sensitive, batch_max_length=batch_max_length,
+                             data_filtering_off=data_filtering_off, workers=workers)
+    dataset = LmdbDataset(lmdbPath, opt)
+    nSamples = len(dataset)
+    input_channel = 3 if rgb else 1
+
+    os.makedirs(outputPath, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(outputPath, SHARD_IMAGES), mode='w+',
+                                       dtype=np.uint8, shape=(nSamples, input_channel, imgH, imgW))
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=256, shuffle=False, num_workers=workers,
+        collate_fn=functools.partial(resize_batch, imgH=imgH, imgW=imgW, keep_ratio_with_pad=PAD))
+
+    cnt = 0
+    label_list = []
+    aspect_ratio_list = []
+    for batch_images, batch_labels, batch_aspect_ratios in data_loader:
+        images[cnt:cnt + len(batch_images)] = batch_images
+        label_list += [label.encode('utf-8') for label in batch_labels]
+        aspect_ratio_list.append(batch_aspect_ratios)
+        cnt += len(batch_images)
+        print('Written %d / %d' % (cnt, nSamples))
+    images.flush()
+    del images
+
+    label_offsets = np.zeros(nSamples + 1, dtype=np.int64)
+    np.cumsum([len(label) for label in label_list], out=label_offsets[1:])
+    with open(os.path.join(outputPath, SHARD_LABELS), 'wb') as f:
+        np.savez(f, label_buffer=np.frombuffer(b''.join(label_list), dtype=np.uint8),
+                 label_offsets=label_offsets, aspect_ratio=np.concatenate(aspect_ratio_list))
+
+    # the meta file is written last, hierarchical_dataset only picks up complete shards.
+    meta = {
+        'source': os.path.abspath(lmdbPath),
+        'num_samples': nSamples,
+        'imgH': imgH,
+        'imgW': imgW,
+        'input_channel': input_channel,
+        'PAD': bool(PAD),
+        'batch_max_length': batch_max_length,
+        'character': str(character),
+        'sensitive': bool(sensitive),
+    }
+    with open(os.path.join(outputPath, SHARD_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print('Created shard with %d samples' % nSamples)
+
+
+if __name__ == '__main__':
+    fire.Fire(createShardDataset)
@@ -1,37 +1,78 @@
 import os
-import sys
+import io
 import re
-import six
+import glob
+import json
 import math
+import time
+import bisect
+import itertools
+import hashlib
+import multiprocessing
 import lmdb
 import torch
 
 from natsort import natsorted
 from PIL import Image
 import numpy as np
-from torch.utils.data import Dataset, ConcatDataset, Subset
+from torch.utils.data import Dataset, ConcatDataset, Subset, Sampler
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
 from torch._utils import _accumulate
 import torchvision.transforms as transforms
 
 DUMMY_LABEL = '[dummy_label]'
 UNLABELED_DATA = '[Unlabeled_data]'
+FILTER_CACHE_VERSION = 2
+# a read transaction is renewed after this many reads, so that it does not pin an old snapshot forever
+LMDB_TXN_RENEW_INTERVAL = 1000
+# files of a pre-decoded shard directory written by create_shard_dataset.py
+SHARD_META = 'shard.json'
+SHARD_IMAGES = 'images.npy'
+SHARD_LABELS = 'labels.npz'
+# below this size the label scan is faster than starting a process pool
+FILTER_PARALLEL_MIN_SAMPLES = 100000
+# reordering of the samples written by repack_lmdb_dataset.py, and the original key of each sample
+LAYOUT_KEY = 'layout'.encode()
+LAYOUT_SOURCE_INDEX_KEY = 'layout-source-index'.encode()
+# per-sample metadata written by create_lmdb_dataset.py, in chunks of samples keyed by their first index
+SAMPLE_METADATA_PREFIX = 'metadata-'.encode()
+SAMPLE_METADATA_COLUMNS = [('label_length', np.uint16), ('width', np.uint16), ('height', np.uint16),
+                           ('unlabeled', np.bool_)]
+# list of the LMDB shards of a dataset written by create_lmdb_dataset.py --shardBytes
+LMDB_SHARDS = 'lmdb_shards.json'
+# index of the sub-datasets of a dataset root written by create_manifest.py
+MANIFEST = 'manifest.json'
+# the content hash of an LMDB is computed per block of keys, independent of the number of workers
+CONTENT_HASH_BLOCK = 100000
+# with pad_to_batch_width, the batch width is rounded up to a multiple of this
+PAD_WIDTH_MULTIPLE = 4
 
 class Batch_Balanced_Dataset(object):
 
-    def __init__(self, opt, train_data, select_data, batch_ratio,is_shuffle=True):
+    def __init__(self, opt, train_data, select_data, batch_ratio,is_shuffle=True, num_workers=None,
+                 infinite=True, in_memory=None, label_encoder=None):
         """
         Modulate the data ratio in the batch.
         For example, when select_data is "MJ-ST" and batch_ratio is "0.5-0.5",
         the 50% of the batch is filled with MJ and the other 50% of the batch is filled with ST.
+        All selected data are read by one DataLoader with num_workers workers (opt.workers by default).
+        With infinite=True, get_batch never starts the DataLoader over, see MixtureBatchSampler.
+        With in_memory (a device), all selected data are decoded once into one uint8 tensor on that device
+        and get_batch gathers the batches from it without any worker, which is meant for small target domains.
+        With label_encoder (labels -> (text, length) tensors), the labels are encoded by the collate function
+        in the workers, and get_batch returns (images, labels, (text, length)).
         """
         print('-' * 80)
         print(
             f'dataset_root: {train_data}\nopt.select_data: { select_data}\nopt.batch_ratio: {batch_ratio}')
         assert len(select_data) == len(batch_ratio)
 
-        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
-        self.data_loader_list = []
-        self.dataloader_iter_list = []
+        # the images are normalized by the trainer, after they are moved to the training device.
+        _AlignCollate = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                     uint8_output=True,
+                                     pad_to_batch_width=getattr(opt, 'pad_to_batch_width', False),
+                                     label_encoder=label_encoder)
+        dataset_list = []
         batch_size_list = []
         Total_batch_size = 0
         self.total_data_size = 0
@@ -52,156 +93,1099 @@ class Batch_Balanced_Dataset(object):
             _dataset, _ = [Subset(_dataset, indices[offset - length:offset])
                            for offset, length in zip(_accumulate(dataset_split), dataset_split)]
 
+            if len(_dataset) == 0:
+                raise ValueError(f'no samples of {selected_d} left in {train_data} after filtering '
+                                 f'and total_data_usage_ratio {opt.total_data_usage_ratio}')
             self.total_data_size += len(_dataset)
             print(
                 f'num total samples of {selected_d}: {total_number_dataset} x {opt.total_data_usage_ratio} (total_data_usage_ratio) = {len(_dataset)}')
             print(
                 f'num samples of {selected_d} per batch: {opt.batch_size} x {float(batch_ratio_d)} (batch_ratio) = {_batch_size}')
-            batch_size_list.append(str(_batch_size))
+            dataset_list.append(_dataset)
+            batch_size_list.append(_batch_size)
             Total_batch_size += _batch_size
 
-            _data_loader = torch.utils.data.DataLoader(
-                _dataset, batch_size=_batch_size,
-                shuffle=is_shuffle,
-                num_workers=int(opt.workers),
-                collate_fn=_AlignCollate, pin_memory=True)
-            self.data_loader_list.append(_data_loader)
-            self.dataloader_iter_list.append(iter(_data_loader))
+        if num_workers is None:
+            num_workers = int(opt.workers)
+        # with PAD, batches can be grouped by aspect ratio to pad less, see MixtureBatchSampler.
+        # Training batches are only grouped if they are padded to their own width, which makes them smaller;
+        # otherwise grouping would only narrow the aspect ratios within each batch.
+        bucket_pool = getattr(opt, 'aspect_ratio_pool', 0) if opt.PAD else 0
+        if bucket_pool and (not getattr(opt, 'pad_to_batch_width', False) or in_memory is not None):
+            print('--aspect_ratio_pool only groups the training batches with --pad_to_batch_width '
+                  'and without an in-memory dataset, they are drawn without grouping')
+            bucket_pool = 0
+        concatenated_dataset = ConcatDataset(dataset_list)
+        aspect_ratio_list = dataset_aspect_ratios(concatenated_dataset) if bucket_pool else None
+        # the sampler yields whole batches of indices, so that each batch is read in one transaction.
+        self.batch_sampler = MixtureBatchSampler([len(d) for d in dataset_list], batch_size_list,
+                                                 shuffle=is_shuffle, infinite=infinite,
+                                                 aspect_ratio_list=aspect_ratio_list, bucket_pool=bucket_pool,
+                                                 block_size=[dataset_block_size(d, opt) for d in dataset_list],
+                                                 block_window=getattr(opt, 'shuffle_window', 1))
+        self.in_memory = in_memory is not None
+        if self.in_memory:
+            self.images, self.labels = decode_dataset(concatenated_dataset, opt, num_workers)
+            self.images = self.images.to(in_memory)
+            # the labels are encoded once as well
+            self.encoded_labels = tuple(t.to(in_memory) for t in label_encoder(self.labels)) \
+                if label_encoder is not None else None
+            self.batch_iter = iter(self.batch_sampler)
+            print(f'decoded {len(self.labels)} samples into {self.images.numel() / 2 ** 20:.1f} MB on {in_memory}')
+        else:
+            self.data_loader = torch.utils.data.DataLoader(
+                BatchFetchDataset(concatenated_dataset), batch_size=None,
+                sampler=self.batch_sampler,
+                num_workers=num_workers,
+                collate_fn=_AlignCollate, pin_memory=True, worker_init_fn=worker_init_fn)
+            # the workers are started by the first get_batch, after the in-memory datasets are decoded
+            self.dataloader_iter = None
         print('-' * 80)
-        print('Total_batch_size: ', '+'.join(batch_size_list), '=', str(Total_batch_size))
+        print('Total_batch_size: ', '+'.join(map(str, batch_size_list)), '=', str(Total_batch_size))
+        print('num workers: ', num_workers)
         opt.batch_size = Total_batch_size
         print('-' * 80)
 
     def get_batch(self):
-        balanced_batch_images = []
-        balanced_batch_texts = []
-
-        for i, data_loader_iter in enumerate(self.dataloader_iter_list):
+        if self.in_memory:
             try:
-                image, text = data_loader_iter.next()
-                balanced_batch_images.append(image)
-                balanced_batch_texts += text
+                indices = next(self.batch_iter)
             except StopIteration:
-                self.dataloader_iter_list[i] = iter(self.data_loader_list[i])
-                image, text = self.dataloader_iter_list[i].next()
-                balanced_batch_images.append(image)
-                balanced_batch_texts += text
-            except ValueError:
-                pass
-
-        balanced_batch_images = torch.cat(balanced_batch_images, 0)
-
-        return balanced_batch_images, balanced_batch_texts
+                self.batch_iter = iter(self.batch_sampler)
+                indices = next(self.batch_iter)
+            index = torch.as_tensor(indices, device=self.images.device)
+            batch = (self.images.index_select(0, index), [self.labels[i] for i in indices])
+            if self.encoded_labels is not None:
+                batch += (tuple(t.index_select(0, index) for t in self.encoded_labels),)
+            return batch
+
+        if self.dataloader_iter is None:
+            self.dataloader_iter = iter(self.data_loader)
+        try:
+            batch = next(self.dataloader_iter)
+        except StopIteration:
+            self.dataloader_iter = iter(self.data_loader)
+            batch = next(self.dataloader_iter)
+
+        return (batch[0], list(batch[1])) + tuple(batch[2:])
+
+
+def split_workers(total_workers, weights):
+    """ split a budget of DataLoader workers proportionally to weights, every loader gets at least one """
+    if total_workers == 0:
+        return [0] * len(weights)
+    if total_workers < len(weights):
+        raise ValueError(f'total_workers {total_workers} is less than one worker for each of the {len(weights)} '
+                         f'loaders, give at least {len(weights)} or 0')
+    weights = np.asarray(weights, dtype=np.float64)
+    # one worker for every loader, the others are split by weight and handed out by largest remainder
+    quotas = (total_workers - len(weights)) * weights / weights.sum()
+    shares = np.floor(quotas).astype(int)
+    for i in np.argsort(shares - quotas, kind='stable')[:total_workers - len(weights) - shares.sum()]:
+        shares[i] += 1
+    shares += 1
+    assert shares.sum() == total_workers, f'{shares.tolist()} do not add up to {total_workers} workers'
+    return shares.tolist()
 
 
 def hierarchical_dataset(root, opt, select_data='/'):
-    """ select_data='/' contains all sub-directory of root directory """
+    """
+    select_data='/' contains all sub-directory of root directory.
+    With a manifest at root (see create_manifest.py), the sub-datasets are taken from it
+    instead of walking the directory tree.
+    """
     dataset_list = []
     print(f'dataset_root:    {root}\t dataset: {select_data[0]}')
-    for dirpath, dirnames, filenames in os.walk(root):
-        if not dirnames:
-            select_flag = False
-            for selected_d in select_data:
-                if selected_d in dirpath:
-                    select_flag = True
-                    break
-
-            if select_flag:
-                print(dirpath)
-                dataset = LmdbDataset(dirpath, opt)
-                print(
-                    f'sub-directory:\t/{os.path.relpath(dirpath, root)}\t num samples: {len(dataset)}')
-                dataset_list.append(dataset)
+    manifest = load_manifest(root)
+    if manifest is not None:
+        sub_datasets = [(root if entry['path'] == '.' else os.path.join(root, entry['path']), entry)
+                        for entry in manifest['datasets']]
+    else:
+        sub_datasets = [(dirpath, None) for dirpath in dataset_dirs(root)]
+
+    for dirpath, entry in sub_datasets:
+        select_flag = False
+        for selected_d in select_data:
+            if selected_d in dirpath:
+                select_flag = True
+                break
+
+        if select_flag:
+            print(dirpath)
+            dataset = open_sub_dataset(dirpath, opt, entry)
+            print(
+                f'sub-directory:\t/{os.path.relpath(dirpath, root)}\t num samples: {len(dataset)}')
+            dataset_list.append(dataset)
 
     concatenated_dataset = ConcatDataset(dataset_list)
 
     return concatenated_dataset
 
 
+def dataset_dirs(root):
+    """ the leaf directories under root, and the directories of sharded LMDBs whose shards are not listed """
+    for dirpath, dirnames, filenames in os.walk(root):
+        if LMDB_SHARDS in filenames:
+            dirnames[:] = []
+            yield dirpath
+        elif not dirnames:
+            yield dirpath
+
+
+def open_sub_dataset(dirpath, opt, entry=None):
+    """ the dataset in the directory dirpath, with its manifest entry if there is one """
+    if entry is None:
+        if os.path.exists(os.path.join(dirpath, SHARD_META)):
+            return ShardDataset(dirpath, opt)
+        if os.path.exists(os.path.join(dirpath, LMDB_SHARDS)):
+            return ShardedLmdbDataset(dirpath, opt)
+        return LmdbDataset(dirpath, opt)
+
+    if entry['format'] == 'shard':
+        return ShardDataset(dirpath, opt)
+    if entry['format'] == 'sharded_lmdb':
+        return ShardedLmdbDataset(dirpath, opt)
+    # the LMDB size recorded in the manifest is only trusted while the LMDB is unchanged.
+    if dataset_stat(dirpath, entry['format']) == entry['stat']:
+        return LmdbDataset(dirpath, opt, num_samples=entry['num_samples'])
+    print(f'{dirpath} changed since the manifest was written, run create_manifest.py again')
+    return LmdbDataset(dirpath, opt)
+
+
+def load_manifest(root):
+    manifest_path = os.path.join(root, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def dataset_stat(dirpath, format):
+    """ size and modification time of the file which changes whenever the dataset at dirpath changes """
+    filename = {'shard': SHARD_META, 'sharded_lmdb': LMDB_SHARDS}.get(format, 'data.mdb')
+    st = os.stat(os.path.join(dirpath, filename))
+    return [st.st_size, st.st_mtime_ns]
+
+
+def content_hash_range(args):
+    """ sha1 of the labels and image sizes of samples [start, end), the image pages are not read """
+    root, start, end = args
+    txn = LmdbReader.get(root).get_txn(end - start, LMDB_TXN_RENEW_INTERVAL)
+    digest = hashlib.sha1()
+    for index in range(start, end):
+        label = bytes(txn.get('label-%09d'.encode() % index))
+        image_size = len(txn.get('image-%09d'.encode() % index))
+        digest.update(b'%d:%s:%d;' % (len(label), label, image_size))
+    return digest.digest()
+
+
+def lmdb_content_blocks(root, nSamples, num_workers=0, content_blocks=(), content_samples=0):
+    """
+    hex digests of the blocks of CONTENT_HASH_BLOCK keys of the LMDB at root. content_blocks are the
+    digests of an earlier scan of its first content_samples keys, before samples were appended;
+    its complete blocks are reused instead of scanned again.
+    """
+    reused = list(content_blocks[:content_samples // CONTENT_HASH_BLOCK])
+    start = len(reused) * CONTENT_HASH_BLOCK + 1
+    block_digests = map_index_ranges(content_hash_range, root, nSamples, num_workers,
+                                     block_size=CONTENT_HASH_BLOCK, start=start)
+    return reused + [block_digest.hex() for block_digest in block_digests]
+
+
+def lmdb_content_hash(nSamples, content_blocks):
+    """ content hash of an LMDB, which identifies its samples independent of the file layout """
+    digest = hashlib.sha1(b'%d;' % nSamples)
+    for block_digest in content_blocks:
+        digest.update(bytes.fromhex(block_digest))
+    return digest.hexdigest()
+
+
+def leaf_datasets(dataset):
+    """ the datasets wrapped by ConcatDataset, Subset and BatchFetchDataset """
+    if isinstance(dataset, ConcatDataset):
+        for d in dataset.datasets:
+            yield from leaf_datasets(d)
+    elif isinstance(dataset, (Subset, BatchFetchDataset)):
+        yield from leaf_datasets(dataset.dataset)
+    else:
+        yield dataset
+
+
+def fetch_batch(dataset, indices):
+    """ samples at indices, read through __getitems__ of the leaf datasets which support batched reads """
+    if isinstance(dataset, Subset):
+        return fetch_batch(dataset.dataset, [dataset.indices[i] for i in indices])
+    if isinstance(dataset, ConcatDataset):
+        groups = {}
+        for position, index in enumerate(indices):
+            dataset_idx = bisect.bisect_right(dataset.cumulative_sizes, index)
+            sample_idx = index - (dataset.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0)
+            groups.setdefault(dataset_idx, []).append((position, sample_idx))
+        batch = [None] * len(indices)
+        for dataset_idx, group in groups.items():
+            samples = fetch_batch(dataset.datasets[dataset_idx], [sample_idx for _, sample_idx in group])
+            for (position, _), sample in zip(group, samples):
+                batch[position] = sample
+        return batch
+    if hasattr(dataset, '__getitems__'):
+        return dataset.__getitems__(indices)
+    return [dataset[index] for index in indices]
+
+
+class BatchFetchDataset(Dataset):
+    """
+    dataset[indices] returns the samples of a whole batch, to be used by a DataLoader
+    with batch_size=None and a BatchSampler as sampler.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return fetch_batch(self.dataset, list(indices))
+
+
+def decode_dataset(dataset, opt, num_workers=0, batch_size=256):
+    """
+    all samples of dataset decoded and resized to imgH x imgW (padded with opt.PAD) as one uint8 tensor,
+    and their labels. The images are read once by a DataLoader with num_workers workers.
+    """
+    data_loader = torch.utils.data.DataLoader(
+        BatchFetchDataset(dataset), batch_size=None,
+        sampler=BatchSampler(SequentialSampler(range(len(dataset))), batch_size, drop_last=False),
+        num_workers=num_workers,
+        collate_fn=AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD, uint8_output=True),
+        worker_init_fn=worker_init_fn)
+    images = []
+    labels = []
+    for image_tensors, batch_labels in data_loader:
+        images.append(image_tensors)
+        labels += batch_labels
+    return torch.cat(images), labels
+
+
+class CachedBatches(object):
+    """
+    The batches of a DataLoader, kept in memory as they were collated (pinned by a DataLoader with
+    pin_memory) after the first pass, together with their labels encoded by encode.
+    Iterating yields (image_tensors, labels, encoded labels), in the order of the first pass every time
+    or, with shuffle, with the cached batches in a new random order every time,
+    so that later validations neither start workers nor decode and resize the images again.
+    """
+
+    def __init__(self, data_loader, encode=None, shuffle=False):
+        self.data_loader = data_loader
+        self.encode = encode
+        self.shuffle = shuffle
+        self.batches = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.batches is not None:
+            order = np.random.permutation(len(self.batches)) if self.shuffle else range(len(self.batches))
+            for i in order:
+                yield self.batches[i]
+            return
+        batches = []
+        for image_tensors, labels in self.data_loader:
+            batch = (image_tensors, labels, self.encode(labels) if self.encode is not None else None)
+            batches.append(batch)
+            yield batch
+        self.batches = batches
+        # the workers and the dataset are not needed anymore.
+        self.data_loader = batches
+
+
+class MixtureBatchSampler(Sampler):
+    """
+    Batches of indices of a ConcatDataset, which take exactly batch_size_list[i] samples of its i-th dataset.
+    Each dataset is drawn in its own order, which starts over (reshuffled in place) whenever it is exhausted.
+    An epoch lasts until every dataset has been drawn completely at least once.
+
+    With infinite=True the iteration never ends, so the DataLoader iterator over it is never torn down:
+    its workers stay alive and keep their prefetch queues full across the epochs of small datasets.
+
+    With aspect_ratio_list (of the whole ConcatDataset), bucket_pool batches are drawn at a time and
+    the samples of each dataset are sorted by aspect ratio across them, so that every batch holds
+    samples of similar width, which keep_ratio_with_pad pads less. The batch ratios stay exact.
+
+    With block_size (one for all datasets or a list of one for each), each dataset is shuffled by
+    block_shuffle_order instead of a full permutation.
+    """
+
+    def __init__(self, dataset_sizes, batch_size_list, shuffle=True, infinite=False, aspect_ratio_list=None,
+                 bucket_pool=0, block_size=0, block_window=1):
+        assert len(dataset_sizes) == len(batch_size_list)
+        if 0 in dataset_sizes:
+            raise ValueError(f'every dataset needs samples to fill its share of a batch, sizes: {list(dataset_sizes)}')
+        self.dataset_sizes = list(dataset_sizes)
+        self.batch_size_list = list(batch_size_list)
+        self.offsets = np.cumsum([0] + self.dataset_sizes[:-1]).tolist()
+        self.shuffle = shuffle
+        self.infinite = infinite
+        self.aspect_ratio_list = aspect_ratio_list
+        self.bucket_pool = bucket_pool
+        if not isinstance(block_size, (list, tuple)):
+            block_size = [block_size] * len(self.dataset_sizes)
+        self.block_size_list = list(block_size)
+        self.block_window = block_window
+
+    def order(self, i):
+        if self.shuffle and self.block_size_list[i] > 1:
+            return block_shuffle_order(self.dataset_sizes[i], self.block_size_list[i], self.block_window)
+        order = np.arange(self.dataset_sizes[i])
+        if self.shuffle:
+            np.random.shuffle(order)
+        return order
+
+    def __len__(self):
+        return max(math.ceil(size / batch_size)
+                   for size, batch_size in zip(self.dataset_sizes, self.batch_size_list))
+
+    def __iter__(self):
+        batches = self.draw_batches()
+        if self.aspect_ratio_list is None or self.bucket_pool <= 1:
+            yield from batches
+            return
+        while True:
+            pool = list(itertools.islice(batches, self.bucket_pool))
+            if not pool:
+                return
+            yield from self.bucket(pool)
+
+    def draw_batches(self):
+        orders = [self.order(i) for i in range(len(self.dataset_sizes))]
+        positions = [0] * len(self.dataset_sizes)
+        num_batches = 0
+        while self.infinite or num_batches < len(self):
+            num_batches += 1
+            batch = []
+            for i, batch_size in enumerate(self.batch_size_list):
+                while batch_size > 0:
+                    if positions[i] == len(orders[i]):
+                        if self.shuffle:
+                            orders[i] = self.order(i)
+                        positions[i] = 0
+                    taken = orders[i][positions[i]:positions[i] + batch_size]
+                    batch += (taken + self.offsets[i]).tolist()
+                    positions[i] += len(taken)
+                    batch_size -= len(taken)
+            yield batch
+
+    def bucket(self, pool):
+        """ regroup a pool of batches so that the k-th batch gets the k-th narrowest slice of each dataset """
+        pool = np.asarray(pool)
+        bucketed = np.empty_like(pool)
+        start = 0
+        for batch_size in self.batch_size_list:
+            samples = pool[:, start:start + batch_size].reshape(-1)
+            samples = samples[np.argsort(self.aspect_ratio_list[samples], kind='stable')]
+            bucketed[:, start:start + batch_size] = samples.reshape(len(pool), batch_size)
+            start += batch_size
+        if self.shuffle:
+            np.random.shuffle(bucketed)
+        return bucketed.tolist()
+
+
+def block_shuffle_order(size, block_size, window):
+    """
+    A shuffled order of range(size) which reads mostly contiguous indices: the blocks of block_size
+    consecutive indices are permuted, then the indices are shuffled within each window of window blocks.
+    A batch drawn from it touches about window runs of contiguous keys instead of batch_size random pages.
+    """
+    num_blocks = math.ceil(size / block_size)
+    blocks = np.random.permutation(num_blocks)
+    order = np.empty(size, dtype=np.int64)
+    position = 0
+    for start in range(0, num_blocks, window):
+        indices = np.concatenate([np.arange(block * block_size, min((block + 1) * block_size, size))
+                                  for block in blocks[start:start + window]])
+        np.random.shuffle(indices)
+        order[position:position + len(indices)] = indices
+        position += len(indices)
+    return order
+
+
+class BlockShuffleSampler(Sampler):
+    """ shuffled indices of a dataset of the given size in block_shuffle_order """
+
+    def __init__(self, size, block_size, window):
+        self.size = size
+        self.block_size = block_size
+        self.window = window
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(block_shuffle_order(self.size, self.block_size, self.window).tolist())
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batches of samples of similar aspect ratio, which draw every sample exactly once.
+    With shuffle, ties are broken randomly and the batches come in random order.
+    """
+
+    def __init__(self, aspect_ratio_list, batch_size, shuffle=False):
+        self.aspect_ratio_list = np.asarray(aspect_ratio_list)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(len(self.aspect_ratio_list) / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.aspect_ratio_list)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        order = order[np.argsort(self.aspect_ratio_list[order], kind='stable')]
+        batches = [order[start:start + self.batch_size].tolist() for start in range(0, n, self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        yield from batches
+
+
+def dataset_block_size(dataset, opt):
+    """
+    the shuffle block size of dataset: opt.shuffle_block_size, or else the block size of its LMDBs if all of
+    them were repacked in random order by repack_lmdb_dataset.py, whose samples then only need to be read
+    in contiguous blocks.
+    """
+    if getattr(opt, 'shuffle_block_size', 0):
+        return opt.shuffle_block_size
+    layouts = [d.layout() if isinstance(d, LmdbDataset) else None for d in leaf_datasets(dataset)]
+    if layouts and all(layout is not None and layout['order'] == 'random' for layout in layouts):
+        return min(layout['block_size'] for layout in layouts)
+    return 0
+
+
+def eval_batch_sampler(dataset, opt, batch_size, shuffle=False):
+    """ batch sampler of the validation and evaluation loaders, by aspect ratio with opt.aspect_ratio_pool """
+    if opt.PAD and getattr(opt, 'aspect_ratio_pool', 0):
+        return AspectRatioBatchSampler(dataset_aspect_ratios(dataset), batch_size, shuffle=shuffle)
+    block_size = dataset_block_size(dataset, opt) if shuffle else 0
+    if block_size > 1:
+        sampler = BlockShuffleSampler(len(dataset), block_size, getattr(opt, 'shuffle_window', 1))
+    else:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return BatchSampler(sampler, batch_size, drop_last=False)
+
+
+def worker_init_fn(worker_id):
+    """ open the LMDB environments of the worker's dataset in the worker itself, not in the parent process """
+    worker_info = torch.utils.data.get_worker_info()
+    for dataset in leaf_datasets(worker_info.dataset):
+        if isinstance(dataset, LmdbDataset):
+            dataset.open_env()
+
+
+class MemoryviewIO(io.RawIOBase):
+    """
+    Read-only file object over a buffer such as the memoryview of an LMDB value,
+    so that the decoder reads straight from the memory-mapped database.
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.buf)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.buf) if size is None or size < 0 else min(self.pos + size, len(self.buf))
+        data = self.buf[self.pos:end].tobytes()
+        self.pos = max(end, self.pos)
+        return data
+
+    def readinto(self, b):
+        # copied straight from the view, without an intermediate bytes object
+        n = max(min(len(b), len(self.buf) - self.pos), 0)
+        b[:n] = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class LmdbReader(object):
+    """
+    Environment of an LMDB and a read transaction which is reused across samples.
+    There is one per LMDB and process, shared by every dataset reading that LMDB:
+    lmdb refuses to open an environment twice in a process, and an environment
+    inherited from the parent process by fork must not be used.
+    """
+    readers = {}
+    readers_pid = None
+
+    def __init__(self, root):
+        # with lock=False, readers take no slot of the lock table, so max_readers does not limit them
+        self.env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False, meminit=False)
+        # with buffers=True, values are memoryviews into the map which stay valid until the transaction ends.
+        self.txn = self.env.begin(write=False, buffers=True)
+        self.reads = 0
+
+    @classmethod
+    def get(cls, root):
+        if cls.readers_pid != os.getpid():
+            for reader in cls.readers.values():
+                reader.env.close()
+            cls.readers = {}
+            cls.readers_pid = os.getpid()
+        root = os.path.abspath(root)
+        if root not in cls.readers:
+            cls.readers[root] = cls(root)
+        return cls.readers[root]
+
+    @classmethod
+    def close(cls, root):
+        reader = cls.readers.pop(os.path.abspath(root), None)
+        if reader is not None and cls.readers_pid == os.getpid():
+            reader.env.close()
+
+    def get_txn(self, reads, renew_interval):
+        if self.reads >= renew_interval:
+            self.txn.abort()
+            self.txn = self.env.begin(write=False, buffers=True)
+            self.reads = 0
+        self.reads += reads
+        return self.txn
+
+
+def filter_cache_key(opt, nSamples):
+    """ everything the filtered index of an LMDB depends on, apart from the LMDB itself """
+    return {
+        'version': FILTER_CACHE_VERSION,
+        'batch_max_length': opt.batch_max_length,
+        'character': str(opt.character),
+        'sensitive': bool(opt.sensitive),
+        'num_samples': nSamples,
+    }
+
+
+def filter_cache_path(root, opt=None, nSamples=None, cache_key=None):
+    """ sidecar file holding the filtered index of the LMDB at root for the given filtering options """
+    if cache_key is None:
+        cache_key = filter_cache_key(opt, nSamples)
+    digest = hashlib.sha1(json.dumps(cache_key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(root, f'filtered_index_{digest}.npz')
+
+
+def pack_labels(index_chunks):
+    """ the filtered index and the packed labels from the results of filter_index_range """
+    filtered_index_list = np.asarray([index for chunk, _ in index_chunks for index in chunk], dtype=np.int32)
+    label_list = [label for _, chunk in index_chunks for label in chunk]
+    label_buffer = np.frombuffer(b''.join(label_list), dtype=np.uint8)
+    label_offsets = np.zeros(len(label_list) + 1, dtype=np.int64)
+    np.cumsum([len(label) for label in label_list], out=label_offsets[1:])
+    return filtered_index_list, label_buffer, label_offsets
+
+
+def extend_sidecars(root, old_nSamples, nSamples, num_workers=0):
+    """
+    After samples old_nSamples + 1..nSamples were appended to the LMDB at root, extend its filtered
+    indices and aspect ratios by scanning only the new keys. The sidecars of the old size are removed.
+    Filtered indices written before they recorded their options are left to be rebuilt on first use.
+    """
+    for cache_path in glob.glob(os.path.join(root, 'filtered_index_*.npz')):
+        with np.load(cache_path) as cache:
+            if 'cache_key' not in cache:
+                continue
+            cache_key = json.loads(str(cache['cache_key']))
+            if cache_key['num_samples'] != old_nSamples:
+                continue
+            arrays = {k: cache[k] for k in ('index', 'label_buffer', 'label_offsets')}
+        new_chunks = map_index_ranges(filter_index_range, root, nSamples, num_workers, cache_key['batch_max_length'],
+                                      cache_key['character'], cache_key['sensitive'], start=old_nSamples + 1)
+        new_index, new_buffer, new_offsets = pack_labels(new_chunks)
+        cache_key['num_samples'] = nSamples
+        write_sidecar(filter_cache_path(root, cache_key=cache_key),
+                      index=np.concatenate([arrays['index'], new_index]),
+                      label_buffer=np.concatenate([arrays['label_buffer'], new_buffer]),
+                      label_offsets=np.concatenate([arrays['label_offsets'],
+                                                    arrays['label_offsets'][-1] + new_offsets[1:]]),
+                      cache_key=json.dumps(cache_key))
+        os.remove(cache_path)
+
+    cache_path = os.path.join(root, f'aspect_ratio_{old_nSamples}.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            ratios = cache['aspect_ratio']
+        new_ratios = map_index_ranges(aspect_ratio_range, root, nSamples, num_workers, start=old_nSamples + 1)
+        write_sidecar(os.path.join(root, f'aspect_ratio_{nSamples}.npz'),
+                      aspect_ratio=np.concatenate([ratios] + new_ratios))
+        os.remove(cache_path)
+    LmdbReader.close(root)
+
+
+def clean_label(label, out_of_char, sensitive):
+    if not sensitive:
+        label = label.lower()
+
+    # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
+    return out_of_char.sub('', label)
+
+
+def filter_index_range(args):
+    """
+    scan the labels of samples [start, end) and return the indices which pass the filtering,
+    together with their cleaned labels encoded in utf-8.
+    """
+    root, start, end, batch_max_length, character, sensitive = args
+    # By default, images containing characters which are not in opt.character are filtered.
+    # You can add [UNK] token to `opt.character` in utils.py instead of this filtering.
+    out_of_char = re.compile(f'[^{character}]')
+    txn = LmdbReader.get(root).get_txn(end - start, LMDB_TXN_RENEW_INTERVAL)
+    metadata = read_sample_metadata(txn, start, end)
+    if metadata is not None:
+        # labels which are too long are dropped without reading them
+        keep = metadata['unlabeled'] | (metadata['label_length'] <= batch_max_length)
+        indices = (np.flatnonzero(keep) + start).tolist()
+    else:
+        indices = range(start, end)
+    filtered_index_list = []
+    label_list = []
+    for index in indices:
+        label_key = 'label-%09d'.encode() % index
+        label = bytes(txn.get(label_key)).decode('utf-8')
+
+        if label != UNLABELED_DATA:
+            if len(label) > batch_max_length:
+                continue
+            if out_of_char.search(label.lower()):
+                continue
+
+        filtered_index_list.append(index)
+        label_list.append(clean_label(label, out_of_char, sensitive).encode('utf-8'))
+    return filtered_index_list, label_list
+
+
+def pack_sample_metadata(rows):
+    """ one value holding the metadata rows (label_length, width, height, unlabeled), column by column """
+    return b''.join(np.asarray(column, dtype=dtype).tobytes()
+                    for column, (_, dtype) in zip(zip(*rows), SAMPLE_METADATA_COLUMNS))
+
+
+def unpack_sample_metadata(value):
+    row_size = sum(np.dtype(dtype).itemsize for _, dtype in SAMPLE_METADATA_COLUMNS)
+    num_rows = len(value) // row_size
+    columns = {}
+    offset = 0
+    for name, dtype in SAMPLE_METADATA_COLUMNS:
+        size = num_rows * np.dtype(dtype).itemsize
+        columns[name] = np.frombuffer(value, dtype=dtype, count=num_rows, offset=offset)
+        offset += size
+    return columns
+
+
+def read_sample_metadata(txn, start, end):
+    """ metadata columns of samples [start, end), None if the LMDB has no metadata for all of them """
+    cursor = txn.cursor()
+    start_key = SAMPLE_METADATA_PREFIX + b'%09d' % start
+    positioned = cursor.set_range(start_key)
+    if not positioned or bytes(cursor.key()) != start_key:
+        # the chunk holding start begins before it
+        if not (cursor.prev() if positioned else cursor.last()):
+            return None
+
+    first = None
+    chunks = []
+    for key, value in cursor:
+        key = bytes(key)
+        if not key.startswith(SAMPLE_METADATA_PREFIX):
+            break
+        chunk_start = int(key[len(SAMPLE_METADATA_PREFIX):])
+        if chunk_start >= end:
+            break
+        if first is None:
+            first = chunk_start
+        chunks.append(unpack_sample_metadata(bytes(value)))
+    if first is None or first > start:
+        return None
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks])[start - first:end - first]
+               for name, _ in SAMPLE_METADATA_COLUMNS}
+    if len(columns['label_length']) != end - start:
+        return None
+    return columns
+
+
+def lmdb_sample_metadata(root, nSamples):
+    """
+    label_length, width, height and unlabeled of all keys of the LMDB at root as arrays,
+    None if it was written without them by an older create_lmdb_dataset.py
+    """
+    metadata = read_sample_metadata(LmdbReader.get(root).get_txn(1, LMDB_TXN_RENEW_INTERVAL),
+                                    1, nSamples + 1)
+    LmdbReader.close(root)
+    return metadata
+
+
+def aspect_ratio_range(args):
+    """ width / height of the images of samples [start, end), read from the image headers only """
+    root, start, end = args
+    txn = LmdbReader.get(root).get_txn(end - start, LMDB_TXN_RENEW_INTERVAL)
+    ratios = np.full(end - start, np.nan, dtype=np.float32)
+    for index in range(start, end):
+        try:
+            w, h = Image.open(MemoryviewIO(txn.get('image-%09d'.encode() % index))).size
+            ratios[index - start] = w / float(h)
+        except IOError:
+            pass  # left as nan, LmdbDataset replaces such images by a dummy image
+    return ratios
+
+
+def lmdb_aspect_ratios(root, nSamples, num_workers=0):
+    """
+    width / height of the images of all keys of the LMDB at root (nan for corrupted ones), from its
+    metadata or else scanned from the image headers once and persisted next to the LMDB.
+    """
+    metadata = lmdb_sample_metadata(root, nSamples)
+    if metadata is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(metadata['height'] > 0, metadata['width'] / metadata['height'].astype(np.float64),
+                            np.nan).astype(np.float32)
+
+    cache_path = os.path.join(root, f'aspect_ratio_{nSamples}.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            return cache['aspect_ratio']
+    ratios = np.concatenate(map_index_ranges(aspect_ratio_range, root, nSamples, num_workers))
+    write_sidecar(cache_path, aspect_ratio=ratios)
+    LmdbReader.close(root)
+    return ratios
+
+
+def map_index_ranges(func, root, nSamples, num_workers, *args, block_size=None, start=1):
+    """
+    func((root, start, end, *args)) over the keys start..nSamples of the LMDB at root, split into ranges
+    which are scanned by a process pool of num_workers for large LMDBs. Returns the results in key order.
+    With block_size, the ranges are the fixed blocks [start, start + block_size), ... whatever the number of workers.
+    """
+    # lmdb starts with 1
+    num_keys = nSamples + 1 - start
+    if block_size is not None:
+        bounds = list(range(start, nSamples + 1, block_size)) + [nSamples + 1]
+    elif num_workers > 1 and num_keys >= FILTER_PARALLEL_MIN_SAMPLES:
+        bounds = np.linspace(start, nSamples + 1, num_workers * 4 + 1).astype(int)
+    else:
+        bounds = [start, nSamples + 1]
+    tasks = [(root, start, end) + args for start, end in zip(bounds[:-1], bounds[1:])]
+    if len(tasks) > 1 and num_workers > 1 and num_keys >= FILTER_PARALLEL_MIN_SAMPLES:
+        with multiprocessing.Pool(num_workers) as pool:
+            return pool.map(func, tasks)
+    return [func(task) for task in tasks]
+
+
+def write_sidecar(path, **arrays):
+    """
+    np.savez the arrays to path. The file is written under a temporary name first,
+    so that concurrent jobs never read a partial file. Read-only dataset directories are tolerated.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'cannot write {path}: {e}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def dataset_aspect_ratios(dataset):
+    """ aspect ratio (width / height) of each sample of dataset, through Subset and ConcatDataset """
+    if isinstance(dataset, Subset):
+        return dataset_aspect_ratios(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([dataset_aspect_ratios(d) for d in dataset.datasets])
+    return dataset.aspect_ratios()
+
+
+def dataset_label_lengths(dataset):
+    """ number of characters of the label of each sample of dataset, through Subset and ConcatDataset """
+    if isinstance(dataset, Subset):
+        return dataset_label_lengths(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([dataset_label_lengths(d) for d in dataset.datasets])
+    return dataset.label_lengths()
+
+
+def buffer_label_lengths(label_buffer, label_offsets):
+    """ number of characters of each utf-8 label packed in label_buffer, without decoding them """
+    # every byte except the continuation bytes 0b10xxxxxx starts a character
+    starts = np.zeros(len(label_buffer) + 1, dtype=np.int64)
+    np.cumsum((label_buffer & 0xC0) != 0x80, out=starts[1:])
+    return starts[label_offsets[1:]] - starts[label_offsets[:-1]]
+
+
+def stratified_subset(dataset, size, seed=0):
+    """
+    A fixed random Subset of size samples of dataset, in which every sub-dataset of a ConcatDataset and
+    every label length keeps its share, e.g. for a quick validation that tracks the full one.
+    """
+    if size >= len(dataset):
+        return dataset
+    lengths = dataset_label_lengths(dataset)
+    if isinstance(dataset, ConcatDataset):
+        sources = np.repeat(np.arange(len(dataset.datasets)), [len(d) for d in dataset.datasets])
+    else:
+        sources = np.zeros(len(dataset), dtype=np.int64)
+    _, strata = np.unique(np.stack([sources, lengths], axis=1), axis=0, return_inverse=True)
+    strata = strata.ravel()
+    counts = np.bincount(strata)
+    # largest remainder apportionment of size over the strata
+    quotas = size * counts / float(len(dataset))
+    take = np.floor(quotas).astype(np.int64)
+    for i in np.argsort(take - quotas, kind='stable')[:size - take.sum()]:
+        take[i] += 1
+    rng = np.random.RandomState(seed)
+    indices = np.concatenate([rng.permutation(np.flatnonzero(strata == stratum))[:n]
+                              for stratum, n in enumerate(take)])
+    return Subset(dataset, np.sort(indices).tolist())
+
+
 class LmdbDataset(Dataset):
 
-    def __init__(self, root, opt):
+    def __init__(self, root, opt, num_samples=None):
+        """ num_samples, if known from a manifest, saves opening the LMDB in the main process """
 
         self.root = root
         self.opt = opt
-        self.env = lmdb.open(root, max_readers=32, readonly=True, lock=False, readahead=False,
-                             meminit=False)
-        if not self.env:
-            print('cannot create lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get('num-samples'.encode()))
-            self.nSamples = nSamples
-
-            if self.opt.data_filtering_off:
-                # for fast check with no filtering
-                self.filtered_index_list = [index + 1 for index in range(self.nSamples)]
-            else:
-                # Filtering
-                self.filtered_index_list = []
-                for index in range(self.nSamples):
-                    index += 1  # lmdb starts with 1
-                    label_key = 'label-%09d'.encode() % index
-                    label = txn.get(label_key).decode('utf-8')
+        self.out_of_char = re.compile(f'[^{self.opt.character}]')
+        # cleaned labels of the filtered samples, packed as one utf-8 buffer sliced by offsets.
+        self.label_buffer = None
+        self.label_offsets = None
+        self.txn_renew_interval = LMDB_TXN_RENEW_INTERVAL
+
+        if num_samples is None:
+            num_samples = int(bytes(self.get_txn().get('num-samples'.encode())))
+        nSamples = num_samples
+        self.nSamples = nSamples
+        self.num_lmdb_samples = nSamples
+        self.aspect_ratio_list = None
+
+        if self.opt.data_filtering_off:
+            # for fast check with no filtering
+            self.filtered_index_list = np.arange(1, self.nSamples + 1, dtype=np.int32)
+        else:
+            self.filtered_index_list, label_buffer, label_offsets = self.load_filtered_index(nSamples)
+            self.nSamples = len(self.filtered_index_list)
+            if not getattr(self.opt, 'label_table_off', False):
+                self.label_buffer, self.label_offsets = label_buffer, label_offsets
 
-                    if label != UNLABELED_DATA:
-                        if len(label) > self.opt.batch_max_length:
-                            # print(f'The length of the label is longer than max_length: length
-                            # {len(label)}, {label} in dataset {self.root}')
-                            continue
+        # the LMDB is opened again lazily by the processes which read the samples, see open_env.
+        LmdbReader.close(self.root)
 
-                        # By default, images containing characters which are not in opt.character are filtered.
-                        # You can add [UNK] token to `opt.character` in utils.py instead of this filtering.
-                        out_of_char = f'[^{self.opt.character}]'
-                        if re.search(out_of_char, label.lower()):
-                            continue
+    def open_env(self):
+        """ open the LMDB in the calling process, see LmdbReader """
+        return LmdbReader.get(self.root)
 
-                    self.filtered_index_list.append(index)
+    def get_txn(self, reads=1):
+        return self.open_env().get_txn(reads, self.txn_renew_interval)
 
-                self.nSamples = len(self.filtered_index_list)
+    def load_filtered_index(self, nSamples):
+        """
+        The filtered index only depends on the filtering options and the LMDB itself,
+        so it is computed once and persisted next to the LMDB. Later runs load it from there.
+
+        The index is kept in numpy arrays rather than python lists, so that the DataLoader workers
+        share its pages with the parent process instead of copying them on write.
+        """
+        cache_key = filter_cache_key(self.opt, nSamples)
+        cache_path = filter_cache_path(self.root, cache_key=cache_key)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                return cache['index'], cache['label_buffer'], cache['label_offsets']
+
+        start_time = time.time()
+        index_chunks = map_index_ranges(filter_index_range, self.root, nSamples, int(self.opt.workers),
+                                        self.opt.batch_max_length, self.opt.character, self.opt.sensitive)
+        filtered_index_list, label_buffer, label_offsets = pack_labels(index_chunks)
+        print(f'filtered {nSamples} samples of {self.root} in {time.time() - start_time:0.1f}s')
+
+        # the options are kept with the index, so that it can be extended after samples are appended.
+        write_sidecar(cache_path, index=filtered_index_list, label_buffer=label_buffer,
+                      label_offsets=label_offsets, cache_key=json.dumps(cache_key))
+        return filtered_index_list, label_buffer, label_offsets
+
+    def aspect_ratios(self):
+        """
+        width / height of the image of each sample, for batching samples of similar width together.
+        The ratios of all keys are scanned from the image headers once and persisted next to the LMDB.
+        """
+        if self.aspect_ratio_list is None:
+            ratios = lmdb_aspect_ratios(self.root, self.num_lmdb_samples, int(self.opt.workers))
+            # corrupted images are replaced by a dummy image of imgW x imgH
+            ratios = np.where(np.isnan(ratios), self.opt.imgW / float(self.opt.imgH), ratios)
+            self.aspect_ratio_list = ratios[self.filtered_index_list - 1]
+        return self.aspect_ratio_list
+
+    def label_lengths(self):
+        """ number of characters of the cleaned label of each sample """
+        if self.label_buffer is not None:
+            return buffer_label_lengths(self.label_buffer, self.label_offsets)
+        txn = self.get_txn(len(self))
+        lengths = np.array([len(clean_label(bytes(txn.get('label-%09d'.encode() % int(index))).decode('utf-8'),
+                                            self.out_of_char, self.opt.sensitive))
+                            for index in self.filtered_index_list], dtype=np.int64)
+        LmdbReader.close(self.root)
+        return lengths
+
+    def sample_metadata(self):
+        """ label_length, width, height and unlabeled of each sample as arrays, None if the LMDB has none """
+        metadata = lmdb_sample_metadata(self.root, self.num_lmdb_samples)
+        if metadata is None:
+            return None
+        return {name: column[self.filtered_index_list - 1] for name, column in metadata.items()}
+
+    def layout(self):
+        """ how the samples were reordered by repack_lmdb_dataset.py, None if they are in gt file order """
+        layout = self.get_txn().get(LAYOUT_KEY)
+        layout = None if layout is None else json.loads(bytes(layout).decode())
+        LmdbReader.close(self.root)
+        return layout
 
     def __len__(self):
         return self.nSamples
 
     def __getitem__(self, index):
+        return self.read_sample(self.get_txn(), index)
+
+    def __getitems__(self, indices):
+        """ read a batch in one transaction, in key order so that LMDB walks its pages sequentially """
+        txn = self.get_txn(reads=len(indices))
+        batch = [None] * len(indices)
+        for position in np.argsort(self.filtered_index_list[indices], kind='stable'):
+            batch[position] = self.read_sample(txn, indices[position])
+        return batch
+
+    def read_sample(self, txn, index):
         assert index <= len(self), 'index range error'
-        index = self.filtered_index_list[index]
+        label = None
+        if self.label_buffer is not None:
+            label = self.label_buffer[self.label_offsets[index]:self.label_offsets[index + 1]]
+            label = label.tobytes().decode('utf-8')
+        index = int(self.filtered_index_list[index])
 
-        with self.env.begin(write=False) as txn:
+        if label is None:
             label_key = 'label-%09d'.encode() % index
-            label = txn.get(label_key).decode('utf-8')
-            img_key = 'image-%09d'.encode() % index
-            imgbuf = txn.get(img_key)
+            label = clean_label(bytes(txn.get(label_key)).decode('utf-8'), self.out_of_char,
+                                self.opt.sensitive)
+        img_key = 'image-%09d'.encode() % index
+        buf = MemoryviewIO(txn.get(img_key))
+        try:
+            img = open_image(buf, self.opt)
 
-            buf = six.BytesIO()
-            buf.write(imgbuf)
-            buf.seek(0)
-            try:
-                if self.opt.rgb:
-                    img = Image.open(buf).convert('RGB')  # for color image
-                else:
-                    img = Image.open(buf).convert('L')
-
-            except IOError:
-                print(f'Corrupted image for {index}')
-                # make dummy image and dummy label for corrupted image.
-                if self.opt.rgb:
-                    img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
-                else:
-                    img = Image.new('L', (self.opt.imgW, self.opt.imgH))
-                label = DUMMY_LABEL
-
-            if not self.opt.sensitive:
-                label = label.lower()
-
-            # We only train and evaluate on alphanumerics (or pre-defined character set in train.py)
-            out_of_char = f'[^{self.opt.character}]'
-            label = re.sub(out_of_char, '', label)
+        except IOError:
+            print(f'Corrupted image for {index}')
+            # make dummy image and dummy label for corrupted image.
+            if self.opt.rgb:
+                img = Image.new('RGB', (self.opt.imgW, self.opt.imgH))
+            else:
+                img = Image.new('L', (self.opt.imgW, self.opt.imgH))
+            label = clean_label(DUMMY_LABEL, self.out_of_char, self.opt.sensitive)
 
         return (img, label)
 
 
+class ShardedLmdbDataset(ConcatDataset):
+    """
+    An LMDB dataset written as several shards by create_lmdb_dataset.py --shardBytes, read as one dataset.
+    ConcatDataset routes a global index to its shard, each shard is an LmdbDataset with its own sidecars.
+    """
+
+    def __init__(self, root, opt):
+        self.root = root
+        with open(os.path.join(root, LMDB_SHARDS)) as f:
+            self.meta = json.load(f)
+        super().__init__([LmdbDataset(os.path.join(root, shard['path']), opt, num_samples=shard['num_samples'])
+                          for shard in self.meta['shards']])
+
+
+class ShardDataset(Dataset):
+    """
+    Samples which are already decoded and resized to imgH x imgW, stored as one uint8 array that is
+    memory-mapped, so a sample is a slice of the page cache without any decoding or resizing.
+    """
+
+    def __init__(self, root, opt):
+
+        self.root = root
+        self.opt = opt
+        with open(os.path.join(root, SHARD_META)) as f:
+            self.meta = json.load(f)
+
+        expected = {
+            'imgH': opt.imgH,
+            'imgW': opt.imgW,
+            'input_channel': 3 if opt.rgb else 1,
+            'PAD': bool(opt.PAD),
+            'batch_max_length': opt.batch_max_length,
+            'character': str(opt.character),
+            'sensitive': bool(opt.sensitive),
+        }
+        mismatch = {k: (self.meta[k], v) for k, v in expected.items() if self.meta[k] != v}
+        if mismatch:
+            raise ValueError(f'shard {root} was created with other options (shard, current): {mismatch}')
+
+        self.images = np.load(os.path.join(root, SHARD_IMAGES), mmap_mode='r')
+        with np.load(os.path.join(root, SHARD_LABELS)) as labels:
+            self.label_buffer = labels['label_buffer']
+            self.label_offsets = labels['label_offsets']
+            # shards written before the aspect ratios were stored count as full width images.
+            if 'aspect_ratio' in labels:
+                self.aspect_ratio_list = labels['aspect_ratio']
+            else:
+                self.aspect_ratio_list = np.full(len(self.images), opt.imgW / float(opt.imgH), dtype=np.float32)
+        self.nSamples = len(self.images)
+
+    def __len__(self):
+        return self.nSamples
+
+    def label_lengths(self):
+        return buffer_label_lengths(self.label_buffer, self.label_offsets)
+
+    def aspect_ratios(self):
+        """ width / height of the source image of each sample """
+        return self.aspect_ratio_list
+
+    def __getitem__(self, index):
+        assert index <= len(self), 'index range error'
+        label = self.label_buffer[self.label_offsets[index]:self.label_offsets[index + 1]]
+
+        return (self.images[index], label.tobytes().decode('utf-8'))
+
+
+def open_image(fp, opt):
+    """
+    Decode an image as RGB (for color image) or L. With opt.jpeg_draft, JPEGs are decoded at the smallest
+    DCT scale (1/8, 1/4, 1/2) which still gives at least the size the image is resized to afterwards.
+    """
+    mode = 'RGB' if opt.rgb else 'L'
+    img = Image.open(fp)
+    if getattr(opt, 'jpeg_draft', False):
+        w, h = img.size
+        img.draft(mode, (resized_width(w, h, opt.imgH, opt.imgW, opt.PAD), opt.imgH))
+    return img.convert(mode)
+
+
 class RawDataset(Dataset):
 
     def __init__(self, root, opt):
@@ -223,10 +1207,7 @@ class RawDataset(Dataset):
     def __getitem__(self, index):
 
         try:
-            if self.opt.rgb:
-                img = Image.open(self.image_path_list[index]).convert('RGB')  # for color image
-            else:
-                img = Image.open(self.image_path_list[index]).convert('L')
+            img = open_image(self.image_path_list[index], self.opt)
 
         except IOError:
             print(f'Corrupted image for {index}')
@@ -273,41 +1254,102 @@ class NormalizePAD(object):
         return Pad_img
 
 
-class AlignCollate(object):
+def resized_width(w, h, imgH, imgW, keep_ratio_with_pad=False):
+    """ width of a w x h image after AlignCollate resized it, before padding """
+    if not keep_ratio_with_pad:
+        return imgW
+    # same concept with 'Rosetta' paper
+    ratio = w / float(h)
+    if math.ceil(imgH * ratio) > imgW:
+        return imgW
+    return math.ceil(imgH * ratio)
+
+
+def resize_image(image, imgH, imgW, keep_ratio_with_pad=False, out=None):
+    """
+    resize a PIL image as AlignCollate does and write it into out, a uint8 [C x imgH x imgW] array
+    which is allocated if not given.
+    """
+    resized_w = resized_width(*image.size, imgH, imgW, keep_ratio_with_pad)
+
+    resized_image = np.asarray(image.resize((resized_w, imgH), Image.BICUBIC), dtype=np.uint8)
+    if resized_image.ndim == 2:
+        resized_image = resized_image[np.newaxis]
+    else:
+        resized_image = resized_image.transpose(2, 0, 1)
+
+    if out is None:
+        out = np.empty((resized_image.shape[0], imgH, imgW), dtype=np.uint8)
+    out[:, :, :resized_w] = resized_image
+    if resized_w != imgW:  # add border Pad
+        out[:, :, resized_w:] = resized_image[:, :, resized_w - 1:resized_w]
+    return out
+
+
+def normalize_images(image_tensors):
+    """
+    uint8 images to float in [-1, 1], the same as ToTensor followed by sub_(0.5).div_(0.5).
+    Run it after moving the batch to the training device to copy a quarter of the bytes.
+    Float images are returned as they are.
+    """
+    if image_tensors.dtype != torch.uint8:
+        return image_tensors
+    return image_tensors.float().div_(255).sub_(0.5).div_(0.5)
 
-    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False):
+
+class AlignCollate(object):
+    """
+    Resize the images of a batch into one uint8 buffer, allocated once per batch (pinned if pin_memory),
+    and normalize the whole batch at once, or leave that to normalize_images if uint8_output.
+    With keep_ratio_with_pad and pad_to_batch_width, the batch is only padded up to its widest image
+    instead of imgW, which only models without a fixed input width (no TPS) accept.
+    With label_encoder, e.g. AttnLabelConverter.encode_batch, the labels are encoded as well and a batch is
+    (images, labels, encoded labels).
+    """
+
+    def __init__(self, imgH=32, imgW=100, keep_ratio_with_pad=False, uint8_output=False, pin_memory=False,
+                 pad_to_batch_width=False, label_encoder=None):
         self.imgH = imgH
         self.imgW = imgW
         self.keep_ratio_with_pad = keep_ratio_with_pad
+        self.uint8_output = uint8_output
+        self.pin_memory = pin_memory
+        self.pad_to_batch_width = pad_to_batch_width
+        self.label_encoder = label_encoder
+
+    def batch_width(self, images):
+        if not (self.keep_ratio_with_pad and self.pad_to_batch_width):
+            return self.imgW
+        # samples of a ShardDataset are already padded to imgW.
+        if any(isinstance(image, np.ndarray) for image in images):
+            return self.imgW
+        width = max(resized_width(*image.size, self.imgH, self.imgW, True) for image in images)
+        return min(math.ceil(width / PAD_WIDTH_MULTIPLE) * PAD_WIDTH_MULTIPLE, self.imgW)
 
     def __call__(self, batch):
         batch = filter(lambda x: x is not None, batch)
         images, labels = zip(*batch)
 
-        if self.keep_ratio_with_pad:  # same concept with 'Rosetta' paper
-            resized_max_w = self.imgW
-            transform = NormalizePAD((1, self.imgH, resized_max_w))
-
-            resized_images = []
-            for image in images:
-                w, h = image.size
-                ratio = w / float(h)
-                if math.ceil(self.imgH * ratio) > self.imgW:
-                    resized_w = self.imgW
-                else:
-                    resized_w = math.ceil(self.imgH * ratio)
-
-                resized_image = image.resize((resized_w, self.imgH), Image.BICUBIC)
-                resized_images.append(transform(resized_image))
-                # resized_image.save('./image_test/%d_test.jpg' % w)
-
-            image_tensors = torch.cat([t.unsqueeze(0) for t in resized_images], 0)
-
+        if isinstance(images[0], np.ndarray):
+            input_channel = images[0].shape[0]
         else:
-            transform = ResizeNormalize((self.imgW, self.imgH))
-            image_tensors = [transform(image) for image in images]
-            image_tensors = torch.cat([t.unsqueeze(0) for t in image_tensors], 0)
+            input_channel = 1 if images[0].mode == 'L' else 3
+        imgW = self.batch_width(images)
+        image_tensors = torch.empty((len(images), input_channel, self.imgH, imgW), dtype=torch.uint8,
+                                    pin_memory=self.pin_memory)
+        image_buffer = image_tensors.numpy()
+        for image, out in zip(images, image_buffer):
+            if isinstance(image, np.ndarray):
+                # samples of a ShardDataset are already resized.
+                out[...] = image
+            else:
+                # the batch width is at least the resized width of every image, which thus stays the same.
+                resize_image(image, self.imgH, imgW, self.keep_ratio_with_pad, out=out)
 
+        if not self.uint8_output:
+            image_tensors = normalize_images(image_tensors)
+        if self.label_encoder is not None:
+            return image_tensors, labels, self.label_encoder(labels)
         return image_tensors, labels
 
 
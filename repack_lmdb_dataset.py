@@ -0,0 +1,105 @@
+""" rewrite an LMDB dataset with its samples reordered, so that training reads its pages mostly sequentially """
+
+import fire
+import os
+import json
+import lmdb
+
+import numpy as np
+
+from dataset import LmdbReader, LMDB_TXN_RENEW_INTERVAL, LAYOUT_KEY, LAYOUT_SOURCE_INDEX_KEY
+from dataset import SAMPLE_METADATA_PREFIX, SAMPLE_METADATA_COLUMNS
+from dataset import lmdb_aspect_ratios, lmdb_sample_metadata, pack_sample_metadata, write_sidecar
+from create_lmdb_dataset import writeCache, PREPROCESS_KEY
+
+ORDERS = ('length', 'aspect', 'random')
+
+
+def repackOrder(lmdbPath, nSamples, labels, order, blockSize=1, seed=0, workers=4):
+    """ the 1-based keys of the source LMDB in the order of the repacked one """
+    index = np.arange(1, nSamples + 1)
+    if order == 'length':
+        return index[np.argsort([len(label.decode('utf-8')) for label in labels], kind='stable')]
+    if order == 'aspect':
+        ratios = lmdb_aspect_ratios(lmdbPath, nSamples, workers)
+        return index[np.argsort(np.nan_to_num(ratios), kind='stable')]
+    # random: blocks of blockSize consecutive samples in random order, a full shuffle with blockSize=1
+    blocks = np.array_split(index, np.arange(blockSize, nSamples, blockSize))
+    return np.concatenate([blocks[i] for i in np.random.RandomState(seed).permutation(len(blocks))])
+
+
+def repackDataset(lmdbPath, outputPath, order='length', blockSize=1, seed=0, workers=4, commitInterval=10000,
+                  mapSize=1073741824):
+    """
+    Rewrite an LMDB dataset with its samples ordered by label length, by aspect ratio or at random.
+    The samples are written with sequential appends in key order, so the new LMDB has no free pages
+    and full leaf pages. The order is stored under LAYOUT_KEY and the source key of every sample
+    under LAYOUT_SOURCE_INDEX_KEY. A random layout lets a block sampler read contiguous runs of keys
+    while the batches stay shuffled.
+    ARGS:
+        lmdbPath   : LMDB dataset created by create_lmdb_dataset.py
+        outputPath : repacked LMDB output path
+        order      : 'length' (of the label), 'aspect' (width / height of the image) or 'random'
+        blockSize  : with 'random', number of consecutive source samples which stay together
+        seed       : random seed of 'random'
+        workers    : number of processes scanning the image headers for 'aspect'
+        commitInterval : number of samples per transaction
+        mapSize    : initial map size of the LMDB in bytes, it is doubled whenever it is full
+    """
+    if order not in ORDERS:
+        raise ValueError(f'order is one of {ORDERS}, not {order}')
+    if os.path.exists(os.path.join(outputPath, 'data.mdb')):
+        raise ValueError(f'{outputPath} already holds a dataset')
+
+    reader = LmdbReader.get(lmdbPath)
+    nSamples = int(bytes(reader.txn.get('num-samples'.encode())))
+    labels = [bytes(reader.txn.get('label-%09d'.encode() % index)) for index in range(1, nSamples + 1)]
+    source_index = repackOrder(lmdbPath, nSamples, labels, order, blockSize, seed, workers)
+    metadata = lmdb_sample_metadata(lmdbPath, nSamples)
+    # both close the LMDB once they have read it
+    reader = LmdbReader.get(lmdbPath)
+
+    os.makedirs(outputPath, exist_ok=True)
+    env = lmdb.open(outputPath, map_size=mapSize)
+    # 'build-preprocess' < 'image-' < 'label-' < 'layout' < 'metadata-' < 'num-samples',
+    # each group is appended in key order
+    preprocess = reader.txn.get(PREPROCESS_KEY)
+    if preprocess is not None:
+        # keeps refusing appends of images which are not preprocessed the same way
+        writeCache(env, {PREPROCESS_KEY: bytes(preprocess)}, append=True)
+    for start in range(0, nSamples, commitInterval):
+        txn = reader.get_txn(commitInterval, LMDB_TXN_RENEW_INTERVAL)
+        cache = {'image-%09d'.encode() % (start + i + 1): bytes(txn.get('image-%09d'.encode() % index))
+                 for i, index in enumerate(source_index[start:start + commitInterval])}
+        writeCache(env, cache, append=True)
+        print('Written %d / %d' % (start + len(cache), nSamples))
+    for start in range(0, nSamples, commitInterval):
+        cache = {'label-%09d'.encode() % (start + i + 1): labels[index - 1]
+                 for i, index in enumerate(source_index[start:start + commitInterval])}
+        writeCache(env, cache, append=True)
+    layout = {'order': order, 'block_size': blockSize, 'seed': seed, 'source': os.path.abspath(lmdbPath)}
+    cache = {
+        LAYOUT_KEY: json.dumps(layout).encode(),
+        LAYOUT_SOURCE_INDEX_KEY: source_index.astype(np.int32).tobytes(),
+    }
+    if metadata is not None:
+        columns = [metadata[name][source_index - 1] for name, _ in SAMPLE_METADATA_COLUMNS]
+        for start in range(0, nSamples, commitInterval):
+            cache[SAMPLE_METADATA_PREFIX + b'%09d' % (start + 1)] = pack_sample_metadata(
+                list(zip(*(column[start:start + commitInterval] for column in columns))))
+    cache['num-samples'.encode()] = str(nSamples).encode()
+    writeCache(env, cache, append=True)
+    env.close()
+    LmdbReader.close(lmdbPath)
+
+    # the aspect ratios are reordered instead of scanned again
+    ratio_path = os.path.join(lmdbPath, f'aspect_ratio_{nSamples}.npz')
+    if os.path.exists(ratio_path):
+        with np.load(ratio_path) as cache:
+            write_sidecar(os.path.join(outputPath, f'aspect_ratio_{nSamples}.npz'),
+                          aspect_ratio=cache['aspect_ratio'][source_index - 1])
+    print('Repacked %d samples by %s' % (nSamples, order))
+
+
+if __name__ == '__main__':
+    fire.Fire(repackDataset)
@@ -9,12 +9,14 @@ import torch
 import torch.backends.cudnn as cudnn
 import torch.utils.data
 
-from dataset import hierarchical_dataset, AlignCollate
+from dataset import hierarchical_dataset, AlignCollate, worker_init_fn, normalize_images, eval_batch_sampler
 from seqda_model import Model
 from utils import AttnLabelConverter, Averager
-from utils import load_char_dict, compute_loss
+from utils import load_char_dict, IndexMetrics
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# predictions of the last validation batch which are decoded to strings, for the log
+NUM_PRINTED_SAMPLES = 5
 
 
 def benchmark_all_eval(model, criterion, converter, opt, calculate_infer_time=False):
@@ -37,13 +39,13 @@ def benchmark_all_eval(model, criterion, converter, opt, calculate_infer_time=Fa
     for eval_data in eval_data_list:
         eval_data_path = os.path.join(opt.eval_data, eval_data)
         AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW,
-                                               keep_ratio_with_pad=opt.PAD)
+                                               keep_ratio_with_pad=opt.PAD,
+                                               pad_to_batch_width=opt.pad_to_batch_width)
         eval_data = hierarchical_dataset(root=eval_data_path, opt=opt)
         evaluation_loader = torch.utils.data.DataLoader(
-            eval_data, batch_size=evaluation_batch_size,
-            shuffle=False,
+            eval_data, batch_sampler=eval_batch_sampler(eval_data, opt, evaluation_batch_size),
             num_workers=int(opt.workers),
-            collate_fn=AlignCollate_evaluation, pin_memory=True)
+            collate_fn=AlignCollate_evaluation, pin_memory=True, worker_init_fn=worker_init_fn)
 
         _, accuracy_by_best_model, norm_ED_by_best_model, _, _, infer_time, length_of_data = validation(
             model, criterion, evaluation_loader, converter, opt)
@@ -83,17 +85,23 @@ def validation(model, criterion, evaluation_loader, converter, opt):
     length_of_data = 0
     infer_time = 0
     valid_loss_avg = Averager()
+    metrics = IndexMetrics(converter, opt)
 
-    for i, (image_tensors, labels) in enumerate(evaluation_loader):
+    for i, batch in enumerate(evaluation_loader):
+        # batches of CachedBatches come with their labels already encoded.
+        image_tensors, labels = batch[:2]
         batch_size = image_tensors.size(0)
         length_of_data = length_of_data + batch_size
-        image = image_tensors.to(device)
+        image = normalize_images(image_tensors.to(device))
         # For max length prediction
         length_for_pred = torch.IntTensor([opt.batch_max_length] * batch_size).to(device)
         text_for_pred = torch.LongTensor(batch_size, opt.batch_max_length + 1).fill_(0).to(device)
 
-        text_for_loss, length_for_loss = converter.encode(labels,
-                                                          batch_max_length=opt.batch_max_length)
+        if len(batch) == 3 and batch[2] is not None:
+            text_for_loss, length_for_loss = batch[2]
+        else:
+            text_for_loss, length_for_loss = converter.encode(labels,
+                                                              batch_max_length=opt.batch_max_length)
 
         start_time = time.time()
 
@@ -107,19 +115,21 @@ def validation(model, criterion, evaluation_loader, converter, opt):
         cost = criterion(preds.contiguous().view(-1, preds.shape[-1]),
                          target.contiguous().view(-1))
 
-        # select max probabilty (greedy decoding) then decode index to character
+        # select max probabilty (greedy decoding), the accuracy is computed on the indices
         preds_score, preds_index = preds.max(2)
-        preds_str = converter.decode(preds_index, length_for_pred)
-        labels = converter.decode(text_for_loss[:, 1:], length_for_loss)
 
         infer_time += forward_time
         valid_loss_avg.add(cost)
 
         # calculate accuracy.
-        batch_n_correct, batch_char_acc = compute_loss(preds_str, labels, opt)
+        batch_n_correct, batch_char_acc = metrics(preds_index, text_for_loss[:, 1:])
         n_correct += batch_n_correct
         norm_ED += batch_char_acc
 
+    # only the printed samples of the last batch are decoded to strings
+    preds_str = converter.decode(preds_index[:NUM_PRINTED_SAMPLES], length_for_pred[:NUM_PRINTED_SAMPLES])
+    labels = converter.decode(text_for_loss[:NUM_PRINTED_SAMPLES, 1:], length_for_loss[:NUM_PRINTED_SAMPLES])
+
     accuracy = n_correct / float(length_of_data) * 100
     norm_ED = norm_ED / float(length_of_data) * 100
 
@@ -172,13 +182,14 @@ def test(opt):
             benchmark_all_eval(model, criterion, converter, opt)
         else:
             AlignCollate_evaluation = AlignCollate(imgH=opt.imgH, imgW=opt.imgW,
-                                                   keep_ratio_with_pad=opt.PAD)
+                                                   keep_ratio_with_pad=opt.PAD,
+                                                   pad_to_batch_width=opt.pad_to_batch_width)
             eval_data = hierarchical_dataset(root=opt.eval_data, opt=opt)
             evaluation_loader = torch.utils.data.DataLoader(
-                eval_data, batch_size=opt.batch_size,
-                shuffle=False,
+                eval_data, batch_sampler=eval_batch_sampler(eval_data, opt, opt.batch_size),
                 num_workers=int(opt.workers),
-                collate_fn=AlignCollate_evaluation, pin_memory=True)
+                collate_fn=AlignCollate_evaluation, pin_memory=True,
+                worker_init_fn=worker_init_fn)
             _, accuracy_by_best_model, char_acc_by_best_model, _, _, _, _ = validation(
                 model, criterion, evaluation_loader, converter, opt)
 
@@ -214,8 +225,17 @@ if __name__ == '__main__':
                         help='for evaluation mode, ignore sensitive character')
     parser.add_argument('--PAD', action='store_true',
                         help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--jpeg_draft', action='store_true',
+                        help='decode JPEGs at a reduced scale which is still larger than imgH x imgW')
+    parser.add_argument('--aspect_ratio_pool', type=int, default=0,
+                        help='with --PAD, group batches by aspect ratio; the number of batches sorted together (0 is off)')
+    parser.add_argument('--pad_to_batch_width', action='store_true',
+                        help='with --PAD, pad a batch only up to its widest image (models with a fixed width, '
+                             'e.g. TPS or the global discriminator, need imgW)')
     parser.add_argument('--data_filtering_off', action='store_true',
                         help='for data_filtering_off mode')
+    parser.add_argument('--label_table_off', action='store_true',
+                        help='read labels from the LMDB per sample instead of the cached label table')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True,
                         help='Transformation stage. None|TPS')
@@ -1,4 +1,5 @@
 import argparse
+import functools
 import os
 import random
 import string
@@ -11,7 +12,8 @@ import torch.nn.init as init
 import torch.optim as optim
 import torch.utils.data
 
-from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset
+from dataset import hierarchical_dataset, AlignCollate, Batch_Balanced_Dataset, worker_init_fn, split_workers
+from dataset import normalize_images, eval_batch_sampler, CachedBatches, stratified_subset
 from modules.domain_adapt import d_cls_inst
 from modules.radam import AdamW, RAdam
 from seqda_model import Model
@@ -54,27 +56,57 @@ class trainer(object):
         self.build_model(opt)
 
     def dataloader(self, opt):
+        # the labels are encoded by the collate function in the loader workers
+        label_encoder = functools.partial(self.converter.encode_batch, batch_max_length=opt.batch_max_length)
+        if opt.total_workers is not None and opt.tar_in_memory:
+            # the target is decoded before the source loader starts its workers, both can use the whole budget
+            src_workers, tar_workers = opt.total_workers, opt.total_workers
+        elif opt.total_workers is not None:
+            src_workers, tar_workers = split_workers(opt.total_workers, [1, 1])
+        else:
+            src_workers, tar_workers = opt.workers, opt.workers
+
         src_train_data = opt.src_train_data
         src_select_data = opt.src_select_data
         src_batch_ratio = opt.src_batch_ratio
         src_train_dataset = Batch_Balanced_Dataset(opt, src_train_data, src_select_data,
-                                                   src_batch_ratio)
+                                                   src_batch_ratio, num_workers=src_workers,
+                                                   label_encoder=label_encoder)
 
         tar_train_data = opt.tar_train_data
         tar_select_data = opt.tar_select_data
         tar_batch_ratio = opt.tar_batch_ratio
         tar_train_dataset = Batch_Balanced_Dataset(opt, tar_train_data, tar_select_data,
-                                                   tar_batch_ratio)
+                                                   tar_batch_ratio, num_workers=tar_workers,
+                                                   in_memory=device if opt.tar_in_memory else None,
+                                                   label_encoder=label_encoder)
 
-        AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD)
+        AlignCollate_valid = AlignCollate(imgH=opt.imgH, imgW=opt.imgW, keep_ratio_with_pad=opt.PAD,
+                                          uint8_output=True, pad_to_batch_width=opt.pad_to_batch_width)
 
         valid_dataset = hierarchical_dataset(root=opt.valid_data, opt=opt)
         valid_loader = torch.utils.data.DataLoader(
-            valid_dataset, batch_size=opt.batch_size,
-            shuffle=True,  # 'True' to check training progress with validation function.
+            valid_dataset,
+            # shuffle to check training progress with validation function.
+            batch_sampler=eval_batch_sampler(valid_dataset, opt, opt.batch_size, shuffle=True),
             num_workers=int(opt.workers),
-            collate_fn=AlignCollate_valid, pin_memory=True)
-        return src_train_dataset, tar_train_dataset, valid_loader
+            collate_fn=AlignCollate_valid, pin_memory=True, worker_init_fn=worker_init_fn)
+        # the validation batches are read once and reused, with their labels already encoded.
+        # They are replayed in a new order every time, so that the validation shows other samples.
+        valid_loader = CachedBatches(valid_loader, encode=lambda labels: self.converter.encode(
+            labels, batch_max_length=opt.batch_max_length), shuffle=True)
+
+        quick_valid_loader = None
+        if opt.quick_valid_size:
+            quick_valid_dataset = stratified_subset(valid_dataset, opt.quick_valid_size)
+            print(f'quick validation on {len(quick_valid_dataset)} of {len(valid_dataset)} samples')
+            quick_valid_loader = CachedBatches(torch.utils.data.DataLoader(
+                quick_valid_dataset,
+                batch_sampler=eval_batch_sampler(quick_valid_dataset, opt, opt.batch_size),
+                num_workers=int(opt.workers),
+                collate_fn=AlignCollate_valid, pin_memory=True, worker_init_fn=worker_init_fn),
+                encode=valid_loader.encode)
+        return src_train_dataset, tar_train_dataset, valid_loader, quick_valid_loader
 
     def _optimizer(self, opt):
         # filter that only require gradient decent
@@ -142,8 +174,11 @@ class trainer(object):
 
         # np.random.seed(opt.RNG_SEED)
 
+        full_valInterval = opt.full_valInterval or 10 * opt.valInterval
+        assert full_valInterval % opt.valInterval == 0, 'full_valInterval must be a multiple of valInterval'
+
         # src, tar dataloaders
-        src_dataset, tar_dataset, valid_loader = self.dataloader(opt)
+        src_dataset, tar_dataset, valid_loader, quick_valid_loader = self.dataloader(opt)
         src_dataset_size = src_dataset.total_data_size
         tar_dataset_size = tar_dataset.total_data_size
         train_size = max([src_dataset_size, tar_dataset_size])
@@ -184,15 +219,13 @@ class trainer(object):
                 # self.d_image_opt.param_groups[0]['lr'] -= (opt.lr / (opt.num_iter // 2))
                 self.d_inst_opt.param_groups[0]['lr'] -= (opt.lr / (opt.num_iter // 2))
 
-            src_image, src_labels = src_dataset.get_batch()
-            src_image = src_image.to(device)
-            src_text, src_length = self.converter.encode(src_labels,
-                                                         batch_max_length=opt.batch_max_length)
+            src_image, src_labels, (src_text, src_length) = src_dataset.get_batch()
+            src_image = normalize_images(src_image.to(device))
+            src_text, src_length = src_text.to(device), src_length.to(device)
 
-            tar_image, tar_labels = tar_dataset.get_batch()
-            tar_image = tar_image.to(device)
-            tar_text, tar_length = self.converter.encode(tar_labels,
-                                                         batch_max_length=opt.batch_max_length)
+            tar_image, tar_labels, (tar_text, tar_length) = tar_dataset.get_batch()
+            tar_image = normalize_images(tar_image.to(device))
+            tar_text, tar_length = tar_text.to(device), tar_length.to(device)
 
             # Set gradient to zero...
             self.model.zero_grad()
@@ -262,7 +295,8 @@ class trainer(object):
             # self.d_image_opt.step()
 
             # validation part
-            if step % opt.valInterval == 0 and step != 0:
+            # the last step is always validated on the whole set
+            if (step % opt.valInterval == 0 and step != 0) or step == opt.num_iter:
 
                 elapsed_time = time.time() - start_time
                 print(
@@ -275,36 +309,50 @@ class trainer(object):
                     cls_loss_avg.reset()
                     sim_loss_avg.reset()
 
+                    # with a quick validation subset, the whole set is only validated every full_valInterval.
+                    full_validation = quick_valid_loader is None or step % full_valInterval == 0 \
+                        or step == opt.num_iter
                     self.model.eval()
                     with torch.no_grad():
-                        valid_loss, current_accuracy, current_norm_ED, preds, labels, infer_time, length_of_data = validation(
-                            self.model, self.criterion, valid_loader, self.converter, opt)
+                        if quick_valid_loader is not None:
+                            quick_loss, quick_accuracy, quick_norm_ED, preds, labels, _, _ = validation(
+                                self.model, self.criterion, quick_valid_loader, self.converter, opt)
+                        if full_validation:
+                            valid_loss, current_accuracy, current_norm_ED, preds, labels, infer_time, length_of_data = validation(
+                                self.model, self.criterion, valid_loader, self.converter, opt)
 
                     self.print_prediction_result(preds, labels, log)
 
-                    valid_log = f'[{step}/{opt.num_iter}] valid loss: {valid_loss:0.5f}'
-                    valid_log += f' accuracy: {current_accuracy:0.3f}, norm_ED: {current_norm_ED:0.2f}'
-                    print(valid_log)
-                    log.write(valid_log + '\n')
+                    if quick_valid_loader is not None:
+                        quick_log = f'[{step}/{opt.num_iter}] quick valid loss: {quick_loss:0.5f}'
+                        quick_log += f' accuracy: {quick_accuracy:0.3f}, norm_ED: {quick_norm_ED:0.2f}'
+                        print(quick_log)
+                        log.write(quick_log + '\n')
+                    if full_validation:
+                        valid_log = f'[{step}/{opt.num_iter}] valid loss: {valid_loss:0.5f}'
+                        valid_log += f' accuracy: {current_accuracy:0.3f}, norm_ED: {current_norm_ED:0.2f}'
+                        print(valid_log)
+                        log.write(valid_log + '\n')
 
                     self.model.train()
 
                     self.local_discriminator.train()
 
-                    # keep best accuracy model
+                    # keep best accuracy model, by the validation on the whole set
 
-                    if current_accuracy > best_accuracy:
-                        best_accuracy = current_accuracy
-                        save_name = f'./saved_models/{opt.experiment_name}/best_accuracy.pth'
-                        self.save(opt, save_name)
-                    if current_norm_ED < best_norm_ED:
-                        best_norm_ED = current_norm_ED
-                        save_name = f'./saved_models/{opt.experiment_name}/best_norm_ED.pth'
-                        self.save(opt, save_name)
+                    if full_validation:
+                        if current_accuracy > best_accuracy:
+                            best_accuracy = current_accuracy
+                            save_name = f'./saved_models/{opt.experiment_name}/best_accuracy.pth'
+                            self.save(opt, save_name)
+                        if current_norm_ED < best_norm_ED:
+                            best_norm_ED = current_norm_ED
+                            save_name = f'./saved_models/{opt.experiment_name}/best_norm_ED.pth'
+                            self.save(opt, save_name)
 
-                    best_model_log = f'best_accuracy: {best_accuracy:0.3f}, best_norm_ED: {best_norm_ED:0.2f}'
-                    print(best_model_log)
-                    log.write(best_model_log + '\n')
+                        best_model_log = f'best_accuracy: {best_accuracy:0.3f}, best_norm_ED: {best_norm_ED:0.2f}'
+                        print(best_model_log)
+                        log.write(best_model_log + '\n')
 
             # save model per 1e+5 iter.
             if (step + 1) % 1e+5 == 0:
@@ -398,11 +446,28 @@ if __name__ == '__main__':
     parser.add_argument('--valid_data', required=True, help='path to validation dataset')
     parser.add_argument('--manualSeed', type=int, default=1111, help='for random seed setting')
     parser.add_argument('--workers', type=int, help='number of data loading workers', default=4)
+    parser.add_argument('--total_workers', type=int, default=None,
+                        help='number of data loading workers shared by the source and target loaders, '
+                             'instead of --workers for each of them, at least one for each loader. '
+                             'With --tar_in_memory, the source loader gets all of them')
+    parser.add_argument('--shuffle_block_size', type=int, default=0,
+                        help='shuffle blocks of this many consecutive samples for mostly sequential LMDB reads '
+                             '(0 shuffles samples, or the blocks of LMDBs repacked in random order)')
+    parser.add_argument('--shuffle_window', type=int, default=32,
+                        help='with --shuffle_block_size, number of blocks whose samples are shuffled together')
+    parser.add_argument('--tar_in_memory', action='store_true',
+                        help='decode the small target training data once and keep it on the training device')
     parser.add_argument('--batch_size', type=int, default=192, help='input batch size')
     parser.add_argument('--num_iter', type=int, default=300000,
                         help='number of iterations to train for')
     parser.add_argument('--valInterval', type=int, default=500,
                         help='Interval between each validation')
+    parser.add_argument('--quick_valid_size', type=int, default=0,
+                        help='validate on a fixed subset of this many samples, stratified by sub-dataset and label '
+                             'length, and only every full_valInterval on the whole set (0 always uses the whole set)')
+    parser.add_argument('--full_valInterval', type=int, default=None,
+                        help='with --quick_valid_size, interval between validations on the whole set, '
+                             'a multiple of valInterval (10 x valInterval by default)')
     parser.add_argument('--continue_model', default='', help="path to model to continue training")
     parser.add_argument('--adam', action='store_true',
                         help='Whether to use adam (default is Adadelta)')
@@ -456,8 +521,18 @@ if __name__ == '__main__':
                         help='for sensitive character mode')
     parser.add_argument('--PAD', action='store_true',
                         help='whether to keep ratio then pad for image resize')
+    parser.add_argument('--jpeg_draft', action='store_true',
+                        help='decode JPEGs at a reduced scale which is still larger than imgH x imgW')
+    parser.add_argument('--aspect_ratio_pool', type=int, default=0,
+                        help='with --PAD, group batches by aspect ratio; the number of batches sorted together '
+                             '(0 is off). Training batches are only grouped with --pad_to_batch_width')
+    parser.add_argument('--pad_to_batch_width', action='store_true',
+                        help='with --PAD, pad a batch only up to its widest image (models with a fixed width, '
+                             'e.g. TPS or the global discriminator, need imgW)')
     parser.add_argument('--data_filtering_off', action='store_true',
                         help='for data_filtering_off mode')
+    parser.add_argument('--label_table_off', action='store_true',
+                        help='read labels from the LMDB per sample instead of the cached label table')
     """ Model Architecture """
     parser.add_argument('--Transformation', type=str, required=True,
                         help='Transformation stage. None|TPS')
@@ -157,6 +157,104 @@ def compute_loss(preds_str, labels, opt, case_sensitive=False, filtering_punctua
     return n_correct, norm_ED
 
 
+class IndexMetrics(object):
+    """
+    compute_loss on batches of character indices (as decoded by converter.decode) without building strings.
+    Every index maps to the codes of its normalized token text through a lookup table, including the
+    quirks of compute_loss: [GO] counts as 'go', and without [s] the last character of the text is dropped.
+    Rows whose text could contain '[s]' across tokens fall back to compute_loss on decoded strings.
+    """
+
+    def __init__(self, converter, opt, case_sensitive=False):
+        self.converter = converter
+        self.opt = opt
+        self.case_sensitive = case_sensitive
+        self.truncate = 'Attn' in opt.Prediction
+        self.eos = converter.dict['[s]']
+
+        def codes(text):
+            if not case_sensitive:
+                text = normalize_text(text).lower()
+            return [ord(c) for c in text]
+
+        tokens = [codes(token) for token in converter.character]
+        # the codes of a token when it is the last one of a text without [s]
+        cut_tokens = [codes(token[:-1]) for token in converter.character]
+        width = max(len(c) for c in tokens + cut_tokens)
+        self.lut = np.full((len(tokens), width), -1, dtype=np.int64)
+        self.cut_lut = np.full((len(tokens), width), -1, dtype=np.int64)
+        for i, (token, cut_token) in enumerate(zip(tokens, cut_tokens)):
+            self.lut[i, :len(token)] = token
+            self.cut_lut[i, :len(cut_token)] = cut_token
+
+        self.multi_char = np.array([len(token) > 1 for token in converter.character])
+        self.multi_char[[converter.dict['[GO]'], self.eos]] = False
+        self.brackets = [converter.dict.get(char) for char in '[s]']
+
+    def fallback_rows(self, index):
+        """ rows in which find('[s]') may not stop at the [s] token """
+        rows = self.multi_char[index].any(axis=1)
+        if None not in self.brackets and index.shape[1] >= 3:
+            left, s, right = self.brackets
+            rows |= ((index[:, :-2] == left) & (index[:, 1:-1] == s) & (index[:, 2:] == right)).any(axis=1)
+        return rows
+
+    def normalize(self, index):
+        """ the codes of the normalized texts of index rows, padded with -1, and their lengths """
+        num_rows, num_tokens = index.shape
+        codes = self.lut[index]
+        if self.truncate:
+            is_eos = index == self.eos
+            has_eos = is_eos.any(axis=1)
+            eos = np.where(has_eos, is_eos.argmax(axis=1), num_tokens)
+            codes[np.arange(num_tokens)[None, :] >= eos[:, None]] = -1
+            codes[~has_eos, -1] = self.cut_lut[index[~has_eos, -1]]
+        codes = codes.reshape(num_rows, -1)
+        # move the codes of every row to its front
+        codes = np.take_along_axis(codes, np.argsort(codes < 0, axis=1, kind='stable'), axis=1)
+        return codes, (codes >= 0).sum(axis=1)
+
+    @staticmethod
+    def edit_distance(a, a_length, b, b_length):
+        """ Levenshtein distances between the rows of a and b, one row of the table for all pairs at a time """
+        num_rows = len(a)
+        columns = np.arange(b.shape[1] + 1)
+        previous = np.tile(columns, (num_rows, 1))
+        distance = previous[np.arange(num_rows), b_length]
+        for i in range(int(a_length.max(initial=0))):
+            step = np.empty_like(previous)
+            step[:, 0] = i + 1
+            step[:, 1:] = np.minimum(previous[:, 1:] + 1, previous[:, :-1] + (a[:, i:i + 1] != b))
+            # insertions along the row: current[j] = min over k <= j of step[k] + j - k
+            current = np.minimum.accumulate(step - columns, axis=1) + columns
+            done = a_length == i + 1
+            distance[done] = current[done, b_length[done]]
+            previous = current
+        return distance
+
+    def __call__(self, preds_index, labels_index):
+        """ n_correct and the sum of the normalized edit distances, the same as compute_loss """
+        preds_index = preds_index.cpu().numpy() if torch.is_tensor(preds_index) else np.asarray(preds_index)
+        labels_index = labels_index.cpu().numpy() if torch.is_tensor(labels_index) else np.asarray(labels_index)
+        pred, pred_length = self.normalize(preds_index)
+        gt, gt_length = self.normalize(labels_index)
+        width = max(pred.shape[1], gt.shape[1])
+        pred = np.pad(pred, ((0, 0), (0, width - pred.shape[1])), constant_values=-1)
+        gt = np.pad(gt, ((0, 0), (0, width - gt.shape[1])), constant_values=-1)
+
+        correct = (pred == gt).all(axis=1)
+        distance = self.edit_distance(pred, pred_length, gt, gt_length)
+        longest = np.maximum(np.maximum(pred_length, gt_length), 1)
+        norm_ED = np.where(gt_length == 0, 1.0, 1 - distance / longest)
+
+        fallback = np.flatnonzero(self.fallback_rows(preds_index) | self.fallback_rows(labels_index))
+        for row in fallback:
+            preds_str = self.converter.decode(preds_index[row:row + 1], [0])
+            labels = self.converter.decode(labels_index[row:row + 1], [0])
+            correct[row], norm_ED[row] = compute_loss(preds_str, labels, self.opt, self.case_sensitive)
+        return int(correct.sum()), float(norm_ED.sum())
+
+
 class AttnLabelConverter(object):
     """ Convert between text-label and text-index """
 
@@ -172,6 +270,35 @@ class AttnLabelConverter(object):
             # print(i, char)
             self.dict[char] = i
 
+        # index of each unicode code point, -1 for the ones which are not in character.
+        # labels are split into single characters, so tokens of several characters never match anyway.
+        single_chars = [(ord(char), i) for char, i in self.dict.items() if len(char) == 1]
+        self.lut = np.full(max(point for point, _ in single_chars) + 1, -1, dtype=np.int64)
+        for point, i in single_chars:
+            self.lut[point] = i
+
+    def encode_batch(self, text, batch_max_length=25):
+        """
+        encode without moving the result to the device, with numpy on the whole batch at once,
+        so that it can run in the collate function of the DataLoader workers. See encode.
+        """
+        length = np.array([len(s) for s in text], dtype=np.int64)
+        if length.max(initial=0) > batch_max_length:
+            raise ValueError(f'labels longer than batch_max_length {batch_max_length}')
+        points = np.frombuffer(''.join(text).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        index = self.lut[np.minimum(points, len(self.lut) - 1)]
+        unknown = (index < 0) | (points >= len(self.lut))
+        if unknown.any():
+            raise KeyError(chr(points[np.argmax(unknown)]))
+
+        batch_text = np.zeros((len(text), batch_max_length + 2), dtype=np.int64)
+        rows = np.repeat(np.arange(len(text)), length)
+        # position of each character in its label, after the [GO] token
+        columns = np.arange(len(points)) - np.repeat(np.cumsum(length) - length, length) + 1
+        batch_text[rows, columns] = index
+        batch_text[np.arange(len(text)), length + 1] = self.dict['[s]']
+        return torch.from_numpy(batch_text), torch.from_numpy((length + 1).astype(np.int32))
+
     def encode(self, text, batch_max_length=25):
         """ convert text-label into text-index.
         input:
@@ -183,17 +310,10 @@ class AttnLabelConverter(object):
                 text[:, 0] is [GO] token and text is padded with [GO] token after [s] token.
             length : the length of output of attention decoder, which count [s] token also. [3, 7, ....] [batch_size]
         """
-        length = [len(s) + 1 for s in text]  # +1 for [s] at end of sentence.
-        # batch_max_length = max(length) # this is not allowed for multi-gpu setting
-        batch_max_length += 1
-        # additional +1 for [GO] at first step. batch_text is padded with [GO] token after [s] token.
-        batch_text = torch.LongTensor(len(text), batch_max_length + 1).fill_(0)
-        for i, t in enumerate(text):
-            text = list(t)
-            text.append('[s]')
-            text = [self.dict[char] for char in text]
-            batch_text[i][1:1 + len(text)] = torch.LongTensor(text)  # batch_text[:, 0] = [GO] token
-        return (batch_text.to(device), torch.IntTensor(length).to(device))
+        # the length counts [s] at end of sentence. batch_max_length = max(length) is not allowed
+        # for multi-gpu setting. +1 for [GO] at first step, batch_text is padded with [GO] token after [s] token.
+        batch_text, length = self.encode_batch(text, batch_max_length)
+        return (batch_text.to(device), length.to(device))
 
     def decode(self, text_index, length):
         """ convert text-index into text-label. """